@@ -67,7 +67,9 @@ setup(
     ],
     test_suite='test',
     extras_require={
-        'memcache': ['python-memcached']
+        'memcache': ['python-memcached'],
+        'fastjson': ['orjson; python_version >= "3.6"',
+                     'ujson; python_version < "3.6"']
     },
     classifiers=[
         'License :: OSI Approved :: BSD License',
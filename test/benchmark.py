@@ -0,0 +1,216 @@
+"""
+End-to-end throughput benchmark for the REST API.
+
+Runs complete register and sign flows, using SoftU2FDevice, through the Flask
+test client against SQLite file databases pre-populated with a given number
+of users, and reports requests per second and latency percentiles for each
+operation. Run it from the project root:
+
+  python -m test.benchmark --users 1,1000,1000000 --output results.json
+
+Results can be compared to those of a previous run (e.g. from another commit)
+by passing --baseline old-results.json.
+"""
+
+from __future__ import print_function
+
+from u2fval import app
+from u2fval.model import db, Client, User, Device
+from u2fval.soft_u2f_v2 import SoftU2FDevice
+from u2fval.bench import summarize
+from u2flib_server.utils import websafe_encode
+from datetime import datetime
+import argparse
+import platform
+import tempfile
+import shutil
+import random
+import json
+import time
+import os
+
+OPERATIONS = [
+    'register_begin',
+    'register_complete',
+    'sign_begin',
+    'sign_complete',
+    'list_devices',
+    'update_properties'
+]
+
+FACET = 'https://example.com'
+ENVIRON = {'REMOTE_USER': 'benchclient'}
+
+
+class Benchmark(object):
+
+    def __init__(self, iterations, devices_per_user, batch_size=10000):
+        self.iterations = iterations
+        self.devices_per_user = devices_per_user
+        self.batch_size = batch_size
+        self.app = app.test_client()
+
+    def _call(self, method, url, latencies, data=None):
+        start = time.time()
+        resp = self.app.open(url, method=method, data=data,
+                             environ_base=ENVIRON)
+        latencies.append(time.time() - start)
+        if resp.status_code != 200:
+            raise Exception('%s %s failed: %s' % (method, url, resp.data))
+        return json.loads(resp.data.decode('utf8'))
+
+    def setup_database(self, uri, n_users):
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        client = Client('benchclient', FACET, [FACET])
+        db.session.add(client)
+        db.session.commit()
+
+        if n_users > 1:
+            self._populate(client.id, n_users - 1)
+
+    def _populate(self, client_id, n_users):
+        """Bulk inserts background users, each with devices_per_user."""
+        device = SoftU2FDevice()
+        reg_req = self._call('GET', '/template/register', [])
+        template = self._call('POST', '/template/register', [], json.dumps({
+            'registerResponse': device.register(
+                FACET, reg_req['appId'], reg_req['registerRequests'][0]).json
+        }))
+        dev = Device.query.filter(Device.handle == template['handle']).one()
+        bind_data = json.loads(dev.bind_data)
+        cert_id = dev.certificate_id
+
+        rand = random.Random(n_users)
+        now = datetime.utcnow()
+        for offset in range(0, n_users, self.batch_size):
+            names = ['user%d' % i for i in range(
+                offset, min(offset + self.batch_size, n_users))]
+            db.session.execute(User.__table__.insert(), [
+                {'client_id': client_id, 'name': name} for name in names])
+            devices = []
+            for user_id, in db.session.query(User.id) \
+                    .filter(User.client_id == client_id) \
+                    .filter(User.name.in_(names)):
+                for _ in range(self.devices_per_user):
+                    bind_data['keyHandle'] = websafe_encode(
+                        bytes(bytearray(rand.getrandbits(8)
+                                        for _ in range(64))))
+                    devices.append({
+                        'handle': '%032x' % rand.getrandbits(128),
+                        'user_id': user_id,
+                        'bind_data': json.dumps(bind_data),
+                        'certificate_id': cert_id,
+                        'compromised': False,
+                        'created_at': now,
+                        'transports': 0
+                    })
+            db.session.execute(Device.__table__.insert(), devices)
+            db.session.commit()
+
+    def run(self):
+        latencies = dict((op, []) for op in OPERATIONS)
+        for i in range(self.iterations):
+            user_id = 'benchuser%d' % i
+            device = SoftU2FDevice()
+            for _ in range(self.devices_per_user):
+                reg_req = self._call('GET', '/%s/register' % user_id,
+                                     latencies['register_begin'])
+                reg_resp = device.register(
+                    FACET, reg_req['appId'], reg_req['registerRequests'][0])
+                desc = self._call('POST', '/%s/register' % user_id,
+                                  latencies['register_complete'],
+                                  json.dumps({'registerResponse': reg_resp}))
+
+            aut_req = self._call('GET', '/%s/sign' % user_id,
+                                 latencies['sign_begin'])
+            key = next(k for k in aut_req['registeredKeys']
+                       if k['keyHandle'] in [websafe_encode(h)
+                                             for h in device.keys])
+            aut_resp = device.getAssertion(FACET, aut_req['appId'],
+                                           aut_req['challenge'], key)
+            self._call('POST', '/%s/sign' % user_id,
+                       latencies['sign_complete'],
+                       json.dumps({'signResponse': aut_resp}))
+
+            self._call('GET', '/%s' % user_id, latencies['list_devices'])
+            self._call('POST', '/%s/%s' % (user_id, desc['handle']),
+                       latencies['update_properties'],
+                       json.dumps({'iteration': str(i)}))
+        return dict((op, summarize(values))
+                    for op, values in latencies.items())
+
+
+def _print_results(n_users, results, baseline=None):
+    print('%d users:' % n_users)
+    print('  %-18s %10s %10s %10s %10s  %s' % (
+        'operation', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'p50 vs baseline' if baseline else ''))
+    for op in OPERATIONS:
+        r = results[op]
+        line = '  %-18s %10.1f %10.2f %10.2f %10.2f' % (
+            op, r['rps'], r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000)
+        if baseline and op in baseline:
+            line += '  %+9.1f%%' % ((r['p50'] / baseline[op]['p50'] - 1) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--users', default='1,1000,100000',
+                        help='comma separated list of user counts to run '
+                        'with (default: %(default)s)')
+    parser.add_argument('--devices-per-user', type=int, default=1,
+                        help='devices per user (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='flows to run per user count '
+                        '(default: %(default)s)')
+    parser.add_argument('--db-dir',
+                        help='directory to create SQLite databases in '
+                        '(default: a temporary directory)')
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--baseline',
+                        help='JSON results of a previous run to compare to')
+    args = parser.parse_args()
+
+    app.config['DEBUG'] = False
+    app.config['TESTING'] = True
+    app.config['ALLOW_UNTRUSTED'] = True
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    db_dir = args.db_dir or tempfile.mkdtemp()
+    bench = Benchmark(args.iterations, args.devices_per_user)
+    results = {}
+    try:
+        for n_users in [int(x) for x in args.users.split(',')]:
+            path = os.path.join(db_dir, 'bench-%d.db' % n_users)
+            if os.path.exists(path):
+                os.remove(path)
+            bench.setup_database('sqlite:///' + path, n_users)
+            results[str(n_users)] = bench.run()
+            _print_results(n_users, results[str(n_users)],
+                           baseline and baseline.get(str(n_users)))
+    finally:
+        db.session.remove()
+        if not args.db_dir:
+            shutil.rmtree(db_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'iterations': args.iterations,
+                'devicesPerUser': args.devices_per_user,
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+JSON encoding and decoding benchmark for the REST API.
+
+Captures the request and response bodies of each endpoint, for a user with a
+given number of devices, and reports the time taken to decode the request
+bodies and encode the responses with each available JSON backend (see
+u2fval.jsonbackend). Run it from the project root:
+
+  python -m test.json_benchmark --devices 1,10,50
+"""
+
+from __future__ import print_function
+
+from u2fval import app, jsonbackend
+from u2fval.model import db, Client
+from u2fval.soft_u2f_v2 import SoftU2FDevice
+from timeit import default_timer as timer
+import argparse
+import json
+
+FACET = 'https://example.com'
+ENVIRON = {'REMOTE_USER': 'benchclient'}
+
+
+def capture(n_devices):
+    """Runs the API flows once, returning a list of (endpoint, request body,
+    response data).
+    """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    db.session.add(Client('benchclient', FACET, [FACET]))
+    db.session.commit()
+    client = app.test_client()
+    captured = []
+
+    def call(endpoint, method, url, data=None):
+        resp = client.open(url, method=method, data=data,
+                           environ_base=ENVIRON)
+        if resp.status_code != 200:
+            raise Exception('%s %s failed: %s' % (method, url, resp.data))
+        result = json.loads(resp.data.decode('utf8'))
+        captured.append((endpoint, data, result))
+        return result
+
+    device = SoftU2FDevice()
+    for _ in range(n_devices):
+        reg_req = call('register_begin', 'GET', '/user/register')
+        reg_resp = device.register(FACET, reg_req['appId'],
+                                   reg_req['registerRequests'][0]).json
+        desc = call('register_complete', 'POST', '/user/register',
+                    json.dumps({'registerResponse': reg_resp,
+                                'properties': {'name': 'Key'}}))
+    aut_req = call('sign_begin', 'GET', '/user/sign')
+    aut_resp = device.getAssertion(FACET, aut_req['appId'],
+                                   aut_req['challenge'],
+                                   aut_req['registeredKeys'][-1]).json
+    call('sign_complete', 'POST', '/user/sign',
+         json.dumps({'signResponse': aut_resp}))
+    call('list_devices', 'GET', '/user')
+    call('update_properties', 'POST', '/user/' + desc['handle'],
+         json.dumps({'name': 'Renamed'}))
+    # Only keep the last call of each endpoint, with all devices registered.
+    return list(dict((c[0], c) for c in captured).values())
+
+
+def measure(func, arg, min_time=0.05):
+    """Returns the average time of func(arg), in microseconds."""
+    n = 0
+    start = timer()
+    while True:
+        func(arg)
+        n += 1
+        elapsed = timer() - start
+        if elapsed >= min_time:
+            return elapsed / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--devices', default='1,10,50',
+                        help='comma separated list of device counts '
+                        '(default: %(default)s)')
+    args = parser.parse_args()
+
+    app.config['DEBUG'] = False
+    app.config['TESTING'] = True
+    app.config['ALLOW_UNTRUSTED'] = True
+
+    backends = []
+    for name in jsonbackend.BACKENDS:
+        try:
+            backends.append(jsonbackend.load_backend(name))
+        except ImportError:
+            print('%s is not installed, skipping.' % name)
+
+    for n_devices in [int(x) for x in args.devices.split(',')]:
+        print('\n%d devices (encode / decode, microseconds):' % n_devices)
+        print('  %-18s %6s' % ('endpoint', 'bytes') + ''.join(
+            ' %17s' % name for name, _, _ in backends))
+        for endpoint, body, result in sorted(capture(n_devices)):
+            size = len(json.dumps(result, separators=(',', ':')))
+            line = '  %-18s %6d' % (endpoint, size)
+            for _, dumps, loads in backends:
+                line += ' %8.1f / ' % measure(dumps, result)
+                line += '%6.1f' % measure(loads, body) if body else '     -'
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
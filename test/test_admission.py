@@ -0,0 +1,130 @@
+from u2fval import app, exc
+from u2fval.admission import Limiter, get_limiter
+from u2fval.model import db, Client
+import threading
+import unittest
+import json
+
+
+class LimiterTest(unittest.TestCase):
+
+    def test_limit(self):
+        limiter = Limiter(2)
+        self.assertTrue(limiter.acquire('a'))
+        self.assertTrue(limiter.acquire('b'))
+        self.assertFalse(limiter.acquire('c'))
+        limiter.release('a')
+        self.assertTrue(limiter.acquire('c'))
+
+    def test_client_limit(self):
+        limiter = Limiter(3, client_limit=1)
+        self.assertTrue(limiter.acquire('a'))
+        self.assertTrue(limiter.acquire('b'))
+        self.assertFalse(limiter.acquire('a'))
+        self.assertTrue(limiter.acquire('c'))
+
+    def test_client_limit_alone(self):
+        limiter = Limiter(4, client_limit=2)
+        self.assertEqual([limiter.acquire('a') for _ in range(5)],
+                         [True, True, True, True, False])
+        limiter.release('a')
+        limiter.release('a')
+        # Other clients get their share once slots free up.
+        self.assertTrue(limiter.acquire('b'))
+        self.assertFalse(limiter.acquire('a'))
+        self.assertTrue(limiter.acquire('b'))
+
+    def test_client_limit_others_waiting(self):
+        limiter = Limiter(2, queue_size=1, timeout=5, client_limit=1)
+        self.assertTrue(limiter.acquire('a'))
+        self.assertTrue(limiter.acquire('a'))
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(limiter.acquire('b')))
+        waiter.start()
+        while limiter._waiting == 0:
+            pass
+        limiter.release('a')
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(limiter._waiting_clients, {})
+
+    def test_queue(self):
+        limiter = Limiter(1, queue_size=1, timeout=5)
+        self.assertTrue(limiter.acquire('a'))
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(limiter.acquire('b')))
+        waiter.start()
+        while limiter._waiting == 0:
+            pass
+        # The queue is full.
+        self.assertFalse(limiter.acquire('c'))
+        limiter.release('a')
+        waiter.join()
+        self.assertEqual(results, [True])
+
+    def test_queue_timeout(self):
+        limiter = Limiter(1, queue_size=1, timeout=0.01)
+        self.assertTrue(limiter.acquire('a'))
+        self.assertFalse(limiter.acquire('b'))
+        self.assertEqual(limiter._waiting, 0)
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['ADMISSION_LIMITS'] = {'read': 2, 'complete': 1}
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+        db.session.add(Client('fooclient', 'https://example.com',
+                              ['https://example.com']))
+        db.session.commit()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config['ADMISSION_LIMITS'] = None
+
+    def test_overloaded(self):
+        limiter = get_limiter('read')
+        self.assertTrue(limiter.acquire('fooclient'))
+        self.assertTrue(limiter.acquire('fooclient'))
+        try:
+            resp = self.app.get('/',
+                                environ_base={'REMOTE_USER': 'fooclient'})
+        finally:
+            limiter.release('fooclient')
+            limiter.release('fooclient')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        err = json.loads(resp.data.decode('utf8'))
+        self.assertEqual(err['errorCode'],
+                         exc.ServiceUnavailableException.code)
+
+    def test_separate_budgets(self):
+        limiter = get_limiter('complete')
+        self.assertTrue(limiter.acquire('fooclient'))
+        try:
+            resp = self.app.get('/',
+                                environ_base={'REMOTE_USER': 'fooclient'})
+            self.assertEqual(resp.status_code, 200)
+            resp = self.app.post('/foouser/sign', data='{}',
+                                 environ_base={'REMOTE_USER': 'fooclient'})
+            self.assertEqual(resp.status_code, 503)
+            resp = self.app.post('/batch', data='[]',
+                                 environ_base={'REMOTE_USER': 'fooclient'})
+            self.assertEqual(resp.status_code, 503)
+        finally:
+            limiter.release('fooclient')
+
+    def test_released(self):
+        for _ in range(3):
+            resp = self.app.get('/',
+                                environ_base={'REMOTE_USER': 'fooclient'})
+            self.assertEqual(resp.status_code, 200)
+        resp = self.app.get('/foouser/sign',
+                            environ_base={'REMOTE_USER': 'fooclient'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(get_limiter('read')._active, 0)
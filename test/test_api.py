@@ -1,15 +1,23 @@
 from u2fval import app, exc
-from u2fval.model import db, Client
-from .soft_u2f_v2 import SoftU2FDevice, CERT
+from u2fval.timing import slow_log, get_sql_stats
+from u2fval.model import (db, Client, User, Transaction,
+                          load_device_records)
+from u2fval.soft_u2f_v2 import SoftU2FDevice, CERT
+from .utils import QueryBudgetMixin, count_queries
 from six.moves.urllib.parse import quote
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.serialization import Encoding
 import unittest
+import tempfile
+import logging
+import shutil
+import pstats
 import json
+import os
 
 
-class RestApiTest(unittest.TestCase):
+class RestApiTest(QueryBudgetMixin, unittest.TestCase):
 
     def setUp(self):
         app.config['TESTING'] = True
@@ -102,6 +110,23 @@ class RestApiTest(unittest.TestCase):
         ).data.decode('utf8'))
         self.assertEqual(desc2['properties'], desc3['properties'])
 
+    def test_update_properties_statements(self):
+        handle = self.do_register(SoftU2FDevice(), {'foo': 'one'})['handle']
+        counts = []
+        for n in [2, 20]:
+            props = dict(('key%d' % i, 'value') for i in range(n))
+            props['foo'] = None
+            props['missing'] = None
+            with count_queries() as statements:
+                resp = self.app.post(
+                    '/foouser/' + handle, data=json.dumps(props),
+                    environ_base={'REMOTE_USER': 'fooclient'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                len(json.loads(resp.data.decode('utf8'))['properties']), n)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
     def test_get_devices(self):
         self.do_register(SoftU2FDevice())
         self.do_register(SoftU2FDevice())
@@ -337,9 +362,347 @@ class RestApiTest(unittest.TestCase):
         self.assertEqual(400, resp.status_code)
         self.assertEqual(11, json.loads(resp.data.decode('utf8'))['errorCode'])
 
-    def do_register(self, device, properties=None):
+    def test_metrics(self):
+        app.config['METRICS_PATH'] = '/metrics'
+        try:
+            self.do_register(SoftU2FDevice())
+            self.app.get('/foouser/sign?handle=foobar',
+                         environ_base={'REMOTE_USER': 'fooclient'})
+            resp = self.app.get('/metrics')
+        finally:
+            app.config['METRICS_PATH'] = None
+        self.assertEqual(resp.status_code, 200)
+        metrics = resp.data.decode('utf8')
+        self.assertIn('u2fval_requests_total{route="register",'
+                      'client="fooclient",status="200"} 2', metrics)
+        self.assertIn('u2fval_request_duration_seconds_count{route="sign",'
+                      'client="fooclient"} 1', metrics)
+        self.assertIn('u2fval_errors_total{code="10"} 1', metrics)
+        self.assertIn('u2fval_transactions 0', metrics)
+
+    def test_server_timing(self):
+        app.config['SERVER_TIMING'] = True
+        try:
+            resp = self.app.get('/foouser/register',
+                                environ_base={'REMOTE_USER': 'fooclient'})
+        finally:
+            app.config['SERVER_TIMING'] = False
+        timing = resp.headers['Server-Timing']
+        for name in ['client', 'user', 'crypto', 'store', 'json', 'total']:
+            self.assertIn(name + ';dur=', timing)
+
+    def test_no_server_timing(self):
+        app.debug = False
+        try:
+            resp = self.app.get('/',
+                                environ_base={'REMOTE_USER': 'fooclient'})
+        finally:
+            app.debug = True
+        self.assertNotIn('Server-Timing', resp.headers)
+
+    def test_server_timing_sql(self):
+        resp = self.app.get('/', environ_base={'REMOTE_USER': 'fooclient'})
+        self.assertIn('sql;desc="1 statements"', resp.headers['Server-Timing'])
+
+    def test_sql_stats_failed_statement(self):
+        with app.test_request_context('/'), db.engine.connect() as conn:
+            conn.execute('SELECT 1')
+            info = dict((k, repr(v)) for k, v in conn.info.items())
+            self.assertRaises(Exception, conn.execute, 'SELECT * FROM nope')
+            conn.execute('SELECT 1')
+            # Nothing is left behind on the (pooled) connection.
+            self.assertEqual(
+                dict((k, repr(v)) for k, v in conn.info.items()), info)
+            statements, seconds = get_sql_stats()
+            self.assertEqual(statements, 2)
+            self.assertLess(seconds, 1)
+
+    def test_query_budget(self):
+        for _ in range(3):
+            self.do_register(SoftU2FDevice(), {'foo': 'bar'})
+        env = {'REMOTE_USER': 'fooclient'}
+        with self.assertMaxQueries(1):
+            self.app.get('/', environ_base=env)
+        with self.assertMaxQueries(6):
+            self.app.get('/foouser', environ_base=env)
+        with self.assertMaxQueries(10):
+            self.app.get('/foouser/register', environ_base=env)
+        with self.assertMaxQueries(10):
+            self.app.get('/foouser/sign', environ_base=env)
+
+    def test_slow_request_log(self):
+        self.do_register(SoftU2FDevice())
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        slow_log.addHandler(handler)
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        try:
+            self.app.get('/foouser/sign',
+                         environ_base={'REMOTE_USER': 'fooclient'})
+        finally:
+            app.config['SLOW_REQUEST_THRESHOLD'] = None
+            slow_log.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        entry = json.loads(records[0].getMessage())
+        self.assertEqual(entry['route'], 'sign')
+        self.assertEqual(entry['client'], 'fooclient')
+        self.assertEqual(entry['user'], 'foouser')
+        self.assertEqual(entry['devices'], 1)
+        self.assertEqual(entry['status'], 200)
+        self.assertGreater(entry['sql_statements'], 0)
+        self.assertGreater(entry['cache_hits'] + entry['cache_misses'], 0)
+        self.assertIn('crypto', entry['phases'])
+
+    def test_profiler(self):
+        tmpdir = tempfile.mkdtemp()
+        app.config.update(PROFILE_DIR=tmpdir, PROFILE_TOKEN='secret',
+                          PROFILE_FLUSH_INTERVAL=0)
+        try:
+            self.app.get('/', environ_base={'REMOTE_USER': 'fooclient'})
+            for token in ['wrong', u'secr\xe9t']:
+                self.app.get('/', environ_base={'REMOTE_USER': 'fooclient'},
+                             headers={'X-U2fval-Profile': token})
+            self.assertEqual(os.listdir(tmpdir), [])
+            self.app.get('/', environ_base={'REMOTE_USER': 'fooclient'},
+                         headers={'X-U2fval-Profile': 'secret'})
+            files = os.listdir(tmpdir)
+            self.assertEqual(len(files), 1)
+            stats = pstats.Stats(os.path.join(tmpdir, files[0]))
+            self.assertIn('trusted_facets',
+                          [func[2] for func in stats.stats])
+        finally:
+            app.config.update(PROFILE_DIR=None, PROFILE_TOKEN=None,
+                              PROFILE_FLUSH_INTERVAL=60)
+            shutil.rmtree(tmpdir)
+
+    def test_missing_user_cache(self):
+        env = {'REMOTE_USER': 'fooclient'}
+        app.config['MISSING_USER_CACHE_TTL'] = 60
+        try:
+            resp = self.app.get('/foouser/sign', environ_base=env)
+            self.assertEqual(resp.status_code, 400)
+            with self.assertMaxQueries(1):  # Client lookup only.
+                resp = self.app.get('/foouser/sign', environ_base=env)
+            self.assertEqual(resp.status_code, 400)
+            with self.assertMaxQueries(1):
+                resp = self.app.get('/foouser', environ_base=env)
+            self.assertEqual(json.loads(resp.data.decode('utf8')), [])
+
+            self.assertNotIn('ETag', resp.headers)
+
+            # Requests changing data don't trust the cache, e.g. if the user
+            # was created by another process.
+            client = Client.query.filter(Client.name == 'fooclient').one()
+            client.users.append(User('foouser'))
+            db.session.commit()
+            resp = self.app.delete('/foouser', environ_base=env)
+            self.assertEqual(resp.status_code, 204)
+            self.assertEqual(User.query.count(), 0)
+
+            # Creating the user invalidates the cache.
+            self.do_register(SoftU2FDevice())
+            resp = self.app.get('/foouser/sign', environ_base=env)
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            app.config['MISSING_USER_CACHE_TTL'] = 0
+
+    def test_user_keys_cache(self):
+        device = SoftU2FDevice()
+        handle = self.do_register(device)['handle']
+        self.do_register(SoftU2FDevice())
+        env = {'REMOTE_USER': 'fooclient'}
+        self.app.get('/foouser/sign', environ_base=env)
+        with count_queries() as statements:
+            resp = self.app.get('/foouser/sign', environ_base=env)
+        self.assertFalse([s for s in statements if 'FROM devices' in s])
+        self.assertEqual(
+            len(json.loads(resp.data.decode('utf8'))['registeredKeys']), 2)
+
+        # Changing a device invalidates the cache.
+        self.app.post('/foouser/' + handle, data=json.dumps({'foo': 'bar'}),
+                      environ_base=env)
+        resp = self.app.get('/foouser/sign', environ_base=env)
+        descriptors = json.loads(resp.data.decode('utf8'))['descriptors']
+        self.assertIn({'foo': 'bar'}, [d['properties'] for d in descriptors])
+        self.app.delete('/foouser/' + handle, environ_base=env)
+        resp = self.app.get('/foouser/sign', environ_base=env)
+        self.assertEqual(
+            len(json.loads(resp.data.decode('utf8'))['registeredKeys']), 1)
+
+    def test_user_etag(self):
+        handle = self.do_register(SoftU2FDevice())['handle']
+        env = {'REMOTE_USER': 'fooclient'}
+        resp = self.app.get('/foouser', environ_base=env)
+        etag = resp.headers['ETag']
+        headers = {'If-None-Match': etag}
+        with count_queries() as statements:
+            resp = self.app.get('/foouser', headers=headers,
+                                environ_base=env)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertFalse([s for s in statements if 'FROM devices' in s])
+        resp = self.app.get('/foouser/' + handle, environ_base=env)
+        device_headers = {'If-None-Match': resp.headers['ETag']}
+        resp = self.app.get('/foouser/' + handle, headers=device_headers,
+                            environ_base=env)
+        self.assertEqual(resp.status_code, 304)
+        # ETags of the user, or of another device, don't match.
+        resp = self.app.get('/foouser/' + handle, headers=headers,
+                            environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.get('/foouser/' + '0' * 32, headers=device_headers,
+                            environ_base=env)
+        self.assertEqual(resp.status_code, 404)
+
+        # Changing a device changes the ETag.
+        self.app.post('/foouser/' + handle, data=json.dumps({'foo': 'bar'}),
+                      environ_base=env)
+        resp = self.app.get('/foouser', headers=headers, environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.get('/foouser/' + handle, headers=device_headers,
+                            environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data.decode('utf8'))['properties'], {'foo': 'bar'})
+
+    def test_trusted_facets_etag(self):
+        env = {'REMOTE_USER': 'fooclient'}
+        resp = self.app.get('/', environ_base=env)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, max-age=300')
+        headers = {'If-None-Match': resp.headers['ETag']}
+        resp = self.app.get('/', headers=headers, environ_base=env)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, max-age=300')
+
+        client = Client.query.filter(Client.name == 'fooclient').one()
+        client.valid_facets = ['https://example.com', 'https://foo.com']
+        db.session.commit()
+        resp = self.app.get('/', headers=headers, environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('https://foo.com', resp.data.decode('utf8'))
+
+    def test_batch(self):
+        handle = self.do_register(SoftU2FDevice(), {'foo': 'bar'})['handle']
+        self.do_register(SoftU2FDevice(), user='baruser')
+        self.do_register(SoftU2FDevice(), user='baruser')
+        env = {'REMOTE_USER': 'fooclient'}
+        with self.assertMaxQueries(5):
+            resp = self.app.post('/batch', data=json.dumps([
+                {'op': 'listDevices', 'user': 'foouser'},
+                {'op': 'listDevices', 'user': 'baruser'},
+                {'op': 'listDevices', 'user': 'nobody'},
+                {'op': 'getDevice', 'user': 'foouser', 'handle': handle},
+            ]), environ_base=env)
+        results = json.loads(resp.data.decode('utf8'))
+        self.assertEqual([r['status'] for r in results], [200] * 4)
+        self.assertEqual(len(results[0]['result']), 1)
+        self.assertEqual(len(results[1]['result']), 2)
+        self.assertEqual(results[2]['result'], [])
+        self.assertEqual(results[3]['result']['properties'], {'foo': 'bar'})
+
+        resp = self.app.post('/batch', data=json.dumps([
+            {'op': 'updateProperties', 'user': 'foouser', 'handle': handle,
+             'properties': {'foo': None, 'baz': 'one'}},
+            {'op': 'getDevice', 'user': 'foouser', 'handle': handle},
+            {'op': 'beginSign', 'user': 'baruser'},
+            {'op': 'beginSign', 'user': 'nobody'},
+            {'op': 'getDevice', 'user': 'baruser', 'handle': handle},
+            {'op': 'getDevice', 'user': 'baruser'},
+            {'op': 'unknown', 'user': 'foouser'},
+            'invalid',
+            {'op': 'beginSign', 'user': 'baruser', 'handles': [1]},
+            {'op': 'updateProperties', 'user': 'foouser', 'handle': handle,
+             'properties': {'x': {'a': 1}}},
+            {'op': 'beginSign', 'user': 'baruser', 'properties': {'x': 1}}
+        ]), environ_base=env)
+        results = json.loads(resp.data.decode('utf8'))
+        self.assertEqual([r['status'] for r in results],
+                         [200, 200, 200, 400, 404, 400, 400, 400, 400, 400,
+                          400])
+        self.assertEqual(results[0]['result']['properties'], {'baz': 'one'})
+        self.assertEqual(results[1]['result']['properties'], {'baz': 'one'})
+        self.assertEqual(len(results[2]['result']['registeredKeys']), 2)
+        self.assertEqual(results[3]['errorCode'],
+                         exc.NoEligibleDevicesException.code)
+        self.assertEqual(results[4]['errorCode'], exc.NotFoundException.code)
+        resp = self.app.get('/foouser/' + handle, environ_base=env)
+        self.assertEqual(
+            json.loads(resp.data.decode('utf8'))['properties'], {'baz': 'one'})
+
+    def test_batch_invalid(self):
+        env = {'REMOTE_USER': 'fooclient'}
+        resp = self.app.post('/batch', data='{}', environ_base=env)
+        self.assertEqual(resp.status_code, 400)
+        resp = self.app.post('/batch', data=json.dumps(
+            [{'op': 'listDevices', 'user': 'foouser'}] * 101),
+            environ_base=env)
+        self.assertEqual(resp.status_code, 400)
+        # A user named "batch" can still be read.
+        resp = self.app.get('/batch', environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data.decode('utf8')), [])
+
+    def test_device_records(self):
+        self.do_register(SoftU2FDevice(), {'foo': 'bar', 'baz': 'one'})
+        self.do_register(SoftU2FDevice())
+        user = User.query.filter(User.name == 'foouser').one()
+        records = load_device_records(user.id)
+        self.assertEqual([r.handle for r in records], list(user.devices))
+        for record in records:
+            dev = user.devices[record.handle]
+            self.assertEqual(record.get_descriptor({'x': 1}),
+                             dev.get_descriptor({'x': 1}))
+            self.assertEqual(record.bind_data, dev.bind_data)
+            self.assertEqual(record.certificate_id, dev.certificate_id)
+        self.assertEqual(load_device_records(user.id + 1), [])
+
+    def test_compact_transactions(self):
+        device = SoftU2FDevice()
+        self.do_register(device)
+        self.app.get('/foouser/sign?properties=' + quote(
+            json.dumps({'foo': 'bar'})),
+            environ_base={'REMOTE_USER': 'fooclient'})
+        data = json.loads(Transaction.query.one()._data)
+        self.assertEqual(sorted(data),
+                         ['appId', 'challenge', 'handles', 'properties'])
+        self.assertEqual(data['properties'], {'foo': 'bar'})
+
+    def test_legacy_transaction(self):
+        device = SoftU2FDevice()
+        self.do_register(device)
+        aut_req = json.loads(
+            self.app.get('/foouser/sign',
+                         environ_base={'REMOTE_USER': 'fooclient'}
+                         ).data.decode('utf8'))
+        # Rewrite the transaction in the format used by older versions.
+        transaction = Transaction.query.one()
+        data = json.loads(transaction._data)
+        user = User.query.one()
+        transaction._data = json.dumps(json.dumps({
+            'appId': data['appId'],
+            'challenge': data['challenge'],
+            'registeredKeys': [json.loads(d.bind_data)
+                               for d in user.devices.values()],
+            'handleMap': data['handles'],
+            'properties': {'foo': 'bar'}
+        }))
+        db.session.commit()
+
+        aut_resp = device.getAssertion('https://example.com', aut_req['appId'],
+                                       aut_req['challenge'],
+                                       aut_req['registeredKeys'][0]).json
+        resp = self.app.post('/foouser/sign',
+                             data=json.dumps({'signResponse': aut_resp}),
+                             environ_base={'REMOTE_USER': 'fooclient'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data.decode('utf8'))['properties'],
+                         {'foo': 'bar'})
+
+    def do_register(self, device, properties=None, user='foouser'):
         reg_req = json.loads(
-            self.app.get('/foouser/register',
+            self.app.get('/%s/register' % user,
                          environ_base={'REMOTE_USER': 'fooclient'}
                          ).data.decode('utf8'))
         self.assertEqual(len(reg_req['registeredKeys']),
@@ -351,7 +714,7 @@ class RestApiTest(unittest.TestCase):
         if properties is None:
             properties = {}
         descriptor = json.loads(self.app.post(
-            '/foouser/register',
+            '/%s/register' % user,
             data=json.dumps({
                 'registerResponse': reg_resp,
                 'properties': properties
@@ -0,0 +1,296 @@
+from u2fval import app
+from u2fval.cli import cli, client_from_path
+from u2fval.model import db, Client, User, Device, Certificate, Property
+from u2fval.soft_u2f_v2 import SoftU2FDevice
+from click.testing import CliRunner
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from datetime import datetime, timedelta
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class CliTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['ALLOW_UNTRUSTED'] = True
+
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+        db.session.add(Client('fooclient', 'https://example.com',
+                              ['https://example.com']))
+        db.session.commit()
+
+        self.app = app.test_client()
+        self.runner = CliRunner()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def invoke(self, *args):
+        result = self.runner.invoke(cli, list(args), catch_exceptions=False)
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result
+
+    def register(self, user_id, properties=None):
+        reg_req = json.loads(self.app.get(
+            '/%s/register' % user_id,
+            environ_base={'REMOTE_USER': 'fooclient'}
+        ).data.decode('utf8'))
+        reg_resp = SoftU2FDevice().register(
+            'https://example.com', reg_req['appId'],
+            reg_req['registerRequests'][0]).json
+        return json.loads(self.app.post(
+            '/%s/register' % user_id,
+            data=json.dumps({
+                'registerResponse': reg_resp,
+                'properties': properties or {}
+            }),
+            environ_base={'REMOTE_USER': 'fooclient'}
+        ).data.decode('utf8'))
+
+    def list_devices(self, user_id):
+        return json.loads(self.app.get(
+            '/' + user_id, environ_base={'REMOTE_USER': 'fooclient'}
+        ).data.decode('utf8'))
+
+    def test_export_import(self):
+        d1 = self.register('user1', {'foo': 'bar'})
+        d2 = self.register('user1')
+        d3 = self.register('user2', {'baz': 'one'})
+
+        path = os.path.join(self.tmpdir, 'export.ndjson')
+        self.invoke('data', 'export', '--chunk-size', '2', path)
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        types = [r['type'] for r in records]
+        self.assertEqual(types.count('certificate'), 1)
+        self.assertEqual(types.count('device'), 3)
+
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+
+        self.invoke('data', 'import', '--batch-size', '2', path)
+        self.assertEqual(Certificate.query.count(), 1)
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(Device.query.count(), 3)
+
+        self.assertEqual(sorted([d1, d2], key=lambda d: d['handle']),
+                         self.list_devices('user1'))
+        self.assertEqual([d3], self.list_devices('user2'))
+
+        # Importing again skips everything
+        result = self.invoke('data', 'import', path)
+        self.assertIn('0 devices', result.output)
+        self.assertEqual(Device.query.count(), 3)
+
+    def test_import_resume_from_checkpoint(self):
+        self.register('user1')
+        self.register('user2')
+
+        path = os.path.join(self.tmpdir, 'export.ndjson')
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        self.invoke('data', 'export', path)
+        with open(path) as f:
+            n_lines = len(f.readlines())
+
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+
+        self.invoke('data', 'import', '--batch-size', '1', '--checkpoint',
+                    checkpoint, path)
+        with open(checkpoint) as f:
+            self.assertEqual(int(f.read()), n_lines)
+        self.assertEqual(Device.query.count(), 2)
+
+        result = self.invoke('data', 'import', '--checkpoint', checkpoint,
+                             path)
+        self.assertIn('Resuming after line %d' % n_lines, result.output)
+
+    def test_client_import_export_csv(self):
+        path = os.path.join(self.tmpdir, 'clients.csv')
+        with open(path, 'w') as f:
+            f.write('name,appId,facets\n'
+                    'fooclient,https://foo.example.com,\n'
+                    'barclient,https://bar.example.com/app-id.json,'
+                    'https://bar.example.com https://www.bar.example.com\n')
+        result = self.invoke('client', 'import', path)
+        self.assertIn('created: 1, updated: 1', result.output)
+
+        foo = Client.query.filter(Client.name == 'fooclient').one()
+        self.assertEqual(foo.app_id, 'https://foo.example.com')
+        self.assertEqual(foo.valid_facets, ['https://foo.example.com'])
+        bar = Client.query.filter(Client.name == 'barclient').one()
+        self.assertEqual(bar.valid_facets, ['https://bar.example.com',
+                                            'https://www.bar.example.com'])
+
+        out = os.path.join(self.tmpdir, 'clients.json')
+        self.invoke('client', 'export', out)
+        with open(out) as f:
+            clients = json.load(f)
+        self.assertEqual(['barclient', 'fooclient'],
+                         [c['name'] for c in clients])
+        self.assertEqual(bar.valid_facets, clients[0]['facets'])
+
+    def test_client_import_changes_etag(self):
+        env = {'REMOTE_USER': 'fooclient'}
+        resp = self.app.get('/', environ_base=env)
+        headers = {'If-None-Match': resp.headers['ETag']}
+        path = os.path.join(self.tmpdir, 'clients.json')
+        with open(path, 'w') as f:
+            json.dump([{
+                'name': 'fooclient',
+                'appId': 'https://foo.example.com',
+                'facets': ['https://foo.example.com']
+            }], f)
+        self.invoke('client', 'import', path)
+        resp = self.app.get('/', headers=headers, environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('https://foo.example.com', resp.data.decode('utf8'))
+
+    def test_client_import_is_validated_first(self):
+        path = os.path.join(self.tmpdir, 'clients.json')
+        with open(path, 'w') as f:
+            json.dump([
+                {'name': 'newclient', 'appId': 'https://new.example.com'},
+                {'name': 'x', 'appId': 'https://x.example.com'}
+            ], f)
+        result = self.runner.invoke(cli, ['client', 'import', path])
+        self.assertIsInstance(result.exception, ValueError)
+        self.assertEqual(Client.query.count(), 1)
+
+    def test_client_import_checks_types(self):
+        path = os.path.join(self.tmpdir, 'clients.json')
+        for entries in [
+            [{'name': 'newclient', 'appId': 'https://new.example.com',
+              'facets': 'https://new.example.com'}],
+            [{'name': 'newclient', 'appId': 'https://new.example.com',
+              'facets': [1]}],
+            ['newclient'],
+            {'name': 'newclient', 'appId': 'https://new.example.com'}
+        ]:
+            with open(path, 'w') as f:
+                json.dump(entries, f)
+            result = self.runner.invoke(cli, ['client', 'import', path])
+            self.assertIsInstance(result.exception, ValueError)
+        self.assertEqual(Client.query.count(), 1)
+
+        path = os.path.join(self.tmpdir, 'clients.csv')
+        with open(path, 'w') as f:
+            f.write('name,facets\nnewclient,https://new.example.com\n')
+        result = self.runner.invoke(cli, ['client', 'import', path])
+        self.assertIsInstance(result.exception, ValueError)
+        self.assertEqual(Client.query.count(), 1)
+
+    def test_client_delete(self):
+        self.register('user1', {'foo': 'bar'})
+        self.register('user2')
+        self.register('user3')
+
+        result = self.invoke('client', 'delete', '--chunk-size', '2',
+                             'fooclient')
+        self.assertIn('Client deleted: fooclient (3 users)', result.output)
+        self.assertEqual(Client.query.count(), 0)
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(Device.query.count(), 0)
+        self.assertEqual(Property.query.count(), 0)
+
+    def test_purge_stale(self):
+        stale = self.register('user1', {'foo': 'bar'})
+        self.register('user2')
+        fresh = self.register('user2')
+        long_ago = datetime.utcnow() - timedelta(days=400)
+        Device.query.filter(Device.handle.in_([stale['handle']])) \
+            .update({'created_at': long_ago}, synchronize_session=False)
+        Device.query.filter(Device.handle != fresh['handle']) \
+            .filter(Device.handle != stale['handle']) \
+            .update({'authenticated_at': long_ago},
+                    synchronize_session=False)
+        db.session.commit()
+
+        result = self.invoke('db', 'purge-stale', '--unused-since', '365',
+                             '--dry-run')
+        self.assertIn('Would delete 2 devices, 1 properties and 1 users',
+                      result.output)
+        self.assertEqual(Device.query.count(), 3)
+
+        result = self.invoke('db', 'purge-stale', '--unused-since', '365',
+                             '--chunk-size', '1')
+        self.assertIn('Deleted 2 devices, 1 properties and 1 users',
+                      result.output)
+        self.assertEqual([], self.list_devices('user1'))
+        self.assertEqual([fresh], self.list_devices('user2'))
+
+    def test_recalc_fingerprints(self):
+        self.register('user1')
+        cert = Certificate.query.one()
+        fingerprint = cert.fingerprint
+        cert.fingerprint = 'invalid'
+        db.session.commit()
+
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        result = self.invoke('db', 'recalc-fingerprints', '--yes',
+                             '--workers', '2', '--checkpoint', checkpoint)
+        self.assertIn('1/1 certificates were modified', result.output)
+        self.assertEqual(fingerprint, Certificate.query.one().fingerprint)
+        with open(checkpoint) as f:
+            self.assertEqual(int(f.read()), cert.id)
+
+    def test_bench(self):
+        server = make_server('localhost', 0, client_from_path(app),
+                             handler_class=_QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            result = self.invoke(
+                'bench', 'http://localhost:%d' % server.server_port,
+                '--client', 'fooclient', '--client-from-path',
+                '-n', '2', '-u', '2', '-k', '2', '-s', '2')
+        finally:
+            server.shutdown()
+        self.assertIn('register_complete: 4 requests, 0 errors',
+                      result.output)
+        self.assertIn('sign_complete: 4 requests, 0 errors', result.output)
+        self.assertEqual(Device.query.count(), 4)
+
+    def test_upgrade(self):
+        db.session.execute('ALTER TABLE clients DROP COLUMN version')
+        db.session.execute('ALTER TABLE users DROP COLUMN version')
+        db.session.commit()
+        result = self.invoke('db', 'upgrade')
+        self.assertIn('Added columns: clients.version, users.version',
+                      result.output)
+        self.register('foouser')
+        self.assertEqual(len(self.list_devices('foouser')), 1)
+        result = self.invoke('db', 'upgrade')
+        self.assertNotIn('Added columns', result.output)
+
+    def test_generate(self):
+        self.invoke('db', 'generate', '--clients', '2', '--users', '5',
+                    '--devices', '3', '--batch-size', '2')
+        self.assertEqual(Client.query.count(), 3)
+        self.assertEqual(User.query.count(), 10)
+        self.assertEqual(Device.query.count(), 30)
+        self.assertEqual(Property.query.count(), 60)
+
+        resp = self.app.get('/user3', environ_base={
+            'REMOTE_USER': 'synthetic-1'})
+        self.assertEqual(len(json.loads(resp.data.decode('utf8'))), 3)
+        resp = self.app.get('/user3/sign', environ_base={
+            'REMOTE_USER': 'synthetic-1'})
+        self.assertEqual(resp.status_code, 200)
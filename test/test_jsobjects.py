@@ -0,0 +1,79 @@
+from u2fval.jsobjects import RegisterResponseData, SignResponseData
+from u2fval.soft_u2f_v2 import SoftU2FDevice
+from u2flib_server.model import U2fRegisterRequest, U2fSignRequest
+import unittest
+import json
+
+APP_ID = 'https://example.com'
+
+
+class ResponseDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.device = SoftU2FDevice()
+        self.reg_req = U2fRegisterRequest.create(APP_ID, [], b'1' * 32)
+        self.reg_resp = json.loads(self.device.register(
+            APP_ID, APP_ID, self.reg_req['registerRequests'][0]).json)
+        key = self.reg_req.complete(self.reg_resp)[0]
+        self.sign_req = U2fSignRequest.create(APP_ID, [key], b'2' * 32)
+        self.sign_resp = json.loads(self.device.getAssertion(
+            APP_ID, APP_ID, self.sign_req['challenge'],
+            self.sign_req['registeredKeys'][0]).json)
+
+    def test_register_wrapped(self):
+        data = RegisterResponseData.wrap({
+            'registerResponse': self.reg_resp,
+            'properties': {'foo': 'bar'}
+        })
+        self.assertEqual(data.properties, {'foo': 'bar'})
+        self.assertEqual(data.registerResponse.clientData['challenge'],
+                         self.reg_req['registerRequests'][0]['challenge'])
+
+    def test_register_bare(self):
+        for value in [self.reg_resp, json.dumps(self.reg_resp)]:
+            data = RegisterResponseData.wrap(value)
+            self.assertEqual(data.properties, {})
+            self.assertEqual(data.registerResponse, self.reg_resp)
+
+    def test_register_invalid(self):
+        with self.assertRaises(ValueError) as cm:
+            RegisterResponseData.wrap({'foo': 'bar'})
+        self.assertIn('Missing required fields', str(cm.exception))
+        data = RegisterResponseData.wrap({'registerResponse': {}})
+        with self.assertRaises(ValueError):
+            data.registerResponse
+
+    def test_register_decodes_once(self):
+        data = RegisterResponseData.wrap({'registerResponse': self.reg_resp})
+        resp = data.registerResponse
+        self.assertIs(resp, data.registerResponse)
+        self.assertIs(resp.clientData, resp.clientData)
+        self.assertIs(resp.registrationData, resp.registrationData)
+        self.reg_req.complete(resp)
+
+    def test_sign_wrapped(self):
+        data = SignResponseData.wrap({
+            'signResponse': self.sign_resp,
+            'properties': {'foo': 'bar'}
+        })
+        self.assertEqual(data.properties, {'foo': 'bar'})
+        self.assertEqual(data.signResponse.clientData['challenge'],
+                         self.sign_req['challenge'])
+
+    def test_sign_bare(self):
+        data = SignResponseData.wrap(self.sign_resp)
+        self.assertEqual(data.properties, {})
+        self.assertEqual(data.signResponse, self.sign_resp)
+
+    def test_sign_invalid(self):
+        with self.assertRaises(ValueError) as cm:
+            SignResponseData.wrap({'foo': 'bar'})
+        self.assertIn('Missing required fields', str(cm.exception))
+
+    def test_sign_decodes_once(self):
+        data = SignResponseData.wrap({'signResponse': self.sign_resp})
+        resp = data.signResponse
+        self.assertIs(resp, data.signResponse)
+        self.assertIs(resp.clientData, resp.clientData)
+        self.assertIs(resp.signatureData, resp.signatureData)
+        self.sign_req.complete(resp)
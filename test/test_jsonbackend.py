@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from u2fval import app, jsonbackend
+from u2fval.model import db, Client
+import unittest
+import json
+
+DATA = {
+    'handle': 'a' * 32,
+    'transports': ['usb', 'nfc'],
+    'compromised': False,
+    'lastUsed': None,
+    'counter': 2 ** 40,
+    'properties': {u'n\xe4me': u'☃ </script>'}
+}
+
+
+class JsonBackendTest(unittest.TestCase):
+
+    def test_backends(self):
+        for name in jsonbackend.BACKENDS:
+            try:
+                _, dumps, loads = jsonbackend.load_backend(name)
+            except ImportError:
+                continue
+            encoded = dumps(DATA)
+            self.assertNotIn(' ', encoded.replace(' </', ''))
+            self.assertEqual(json.loads(encoded), DATA)
+            self.assertEqual(loads(encoded), DATA)
+            self.assertEqual(loads(encoded.encode('utf8')), DATA)
+
+    def test_auto(self):
+        name, _, _ = jsonbackend.load_backend('auto')
+        self.assertIn(name, jsonbackend.BACKENDS)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, jsonbackend.load_backend, 'foo')
+
+
+class JsonResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+        db.session.add(Client('fooclient', 'https://example.com',
+                              ['https://example.com']))
+        db.session.commit()
+        self.app = app.test_client()
+
+    def test_compact(self):
+        resp = self.app.get('/', environ_base={'REMOTE_USER': 'fooclient'})
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertNotIn(b'\n ', resp.data)
+
+    def test_pretty(self):
+        app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+        try:
+            resp = self.app.get('/',
+                                environ_base={'REMOTE_USER': 'fooclient'})
+        finally:
+            app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+        self.assertIn(b'\n  "trustedFacets": [', resp.data)
+
+    def test_stdlib_backend(self):
+        backend = jsonbackend.backend
+        jsonbackend.set_backend('json')
+        try:
+            resp = self.app.get('/foouser/register?properties=%7B%22a%22'
+                                '%3A%201%7D',
+                                environ_base={'REMOTE_USER': 'fooclient'})
+        finally:
+            jsonbackend.set_backend(backend)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_invalid_json(self):
+        resp = self.app.post('/foouser/register', data='{invalid',
+                             environ_base={'REMOTE_USER': 'fooclient'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.data.decode('utf8'))['errorCode'],
+                         10)
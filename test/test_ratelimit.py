@@ -0,0 +1,134 @@
+from u2fval import app, exc
+from u2fval.ratelimit import (LocalBuckets, CacheBuckets, get_limits,
+                              client_name)
+from u2fval.model import db, Client
+from werkzeug.contrib.cache import SimpleCache
+from .utils import QueryBudgetMixin
+from base64 import b64encode
+import unittest
+import json
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class LocalBucketsTest(unittest.TestCase):
+
+    def test_take(self):
+        clock = Clock()
+        buckets = LocalBuckets(clock=clock)
+        for _ in range(3):
+            self.assertEqual(buckets.take('a', 2, 3), 0)
+        self.assertAlmostEqual(buckets.take('a', 2, 3), 0.5)
+        self.assertEqual(buckets.take('b', 2, 3), 0)
+        clock.now += 0.5
+        self.assertEqual(buckets.take('a', 2, 3), 0)
+        self.assertGreater(buckets.take('a', 2, 3), 0)
+
+    def test_prune(self):
+        clock = Clock()
+        buckets = LocalBuckets(max_size=2, clock=clock)
+        buckets.take('a', 1, 1)
+        buckets.take('b', 1, 1)
+        buckets.take('a', 1, 1)
+        buckets.take('c', 1, 1)
+        self.assertEqual(sorted(buckets._buckets), ['a', 'c'])
+        for i in range(1000):
+            buckets.take(str(i), 1, 1)
+        self.assertEqual(len(buckets._buckets), 2)
+
+
+class CacheBucketsTest(unittest.TestCase):
+
+    def test_take(self):
+        clock = Clock(1001.0)
+        buckets = CacheBuckets(SimpleCache(), clock=clock)
+        for _ in range(4):
+            self.assertEqual(buckets.take('a', 2, 4), 0)
+        self.assertEqual(buckets.take('a', 2, 4), 1)
+        self.assertEqual(buckets.take('b', 2, 4), 0)
+        clock.now += 1
+        self.assertEqual(buckets.take('a', 2, 4), 0)
+
+
+class RateLimitTest(QueryBudgetMixin, unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+        db.session.add(Client('fooclient', 'https://example.com',
+                              ['https://example.com']))
+        db.session.commit()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config.update(RATE_LIMIT_CLIENT=None, RATE_LIMIT_USER=None,
+                          RATE_LIMITS={})
+
+    def test_get_limits(self):
+        app.config.update(RATE_LIMIT_CLIENT=(10, 20), RATE_LIMIT_USER=(1, 2),
+                          RATE_LIMITS={'other': {'user': None}})
+        self.assertEqual(get_limits('fooclient'), ((10, 20), (1, 2)))
+        self.assertEqual(get_limits('other'), ((10, 20), None))
+
+    def test_user_limit(self):
+        app.config['RATE_LIMITS'] = {'fooclient': {'user': (0.001, 2)}}
+        env = {'REMOTE_USER': 'fooclient'}
+        for _ in range(2):
+            resp = self.app.get('/limiteduser', environ_base=env)
+            self.assertEqual(resp.status_code, 200)
+        with self.assertMaxQueries(0):
+            resp = self.app.get('/limiteduser/sign', environ_base=env)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '1000')
+        err = json.loads(resp.data.decode('utf8'))
+        self.assertEqual(err['errorCode'], exc.TooManyRequestsException.code)
+
+        # Other users, and requests not for a user, are not affected.
+        resp = self.app.get('/otheruser', environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.get('/', environ_base=env)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_batch_user_limit(self):
+        app.config['RATE_LIMITS'] = {'fooclient': {'user': (0.001, 2)}}
+        resp = self.app.post('/batch', data=json.dumps(
+            [{'op': 'beginSign', 'user': 'batchuser'}] * 3 +
+            [{'op': 'listDevices', 'user': 'otheruser'}]),
+            environ_base={'REMOTE_USER': 'fooclient'})
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.data.decode('utf8'))
+        self.assertEqual([r['status'] for r in results], [400, 400, 429, 200])
+        self.assertEqual(results[2]['errorCode'],
+                         exc.TooManyRequestsException.code)
+
+    def test_client_name(self):
+        headers = {'Authorization': 'Basic ' + b64encode(
+            b'fooclient:').decode('ascii')}
+        with app.test_request_context('/', headers=headers):
+            self.assertEqual(client_name(), 'fooclient')
+            app.debug = False
+            try:
+                self.assertIsNone(client_name())
+            finally:
+                app.debug = True
+        with app.test_request_context('/', headers=headers,
+                                      environ_base={'REMOTE_USER': 'bar'}):
+            self.assertEqual(client_name(), 'bar')
+
+    def test_client_limit(self):
+        app.config['RATE_LIMITS'] = {'limitedclient': {'client': (0.001, 1)}}
+        resp = self.app.get('/', environ_base={'REMOTE_USER': 'limitedclient'})
+        self.assertEqual(resp.status_code, 404)
+        resp = self.app.get('/', environ_base={'REMOTE_USER': 'limitedclient'})
+        self.assertEqual(resp.status_code, 429)
+        resp = self.app.get('/', environ_base={'REMOTE_USER': 'fooclient'})
+        self.assertEqual(resp.status_code, 200)
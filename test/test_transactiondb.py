@@ -0,0 +1,67 @@
+from u2fval import app
+from u2fval.model import db, Client, User, Transaction
+from u2fval.transactiondb import DBStore
+from .utils import QueryBudgetMixin
+from datetime import datetime, timedelta
+import unittest
+
+
+class DBStoreTest(QueryBudgetMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+        client = Client('fooclient', 'https://example.com',
+                        ['https://example.com'])
+        db.session.add(client)
+        db.session.commit()
+        self.client_id = client.id
+        self.store = DBStore(max_transactions=3)
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_store_and_retrieve(self):
+        self.store.store(self.client_id, 'foouser', b'tx1', '{"a": 1}')
+        self.assertEqual(User.query.count(), 1)
+        with self.assertMaxQueries(5):
+            self.store.store(self.client_id, 'foouser', b'tx2', '{"b": 2}')
+        self.assertEqual(
+            self.store.retrieve(self.client_id, 'foouser', b'tx1'),
+            '{"a": 1}')
+        self.assertRaises(ValueError, self.store.retrieve, self.client_id,
+                          'foouser', b'tx1')
+        self.assertEqual(Transaction.query.count(), 1)
+
+    def test_retrieve_wrong_user(self):
+        self.store.store(self.client_id, 'foouser', b'tx1', '{}')
+        self.assertRaises(ValueError, self.store.retrieve, self.client_id,
+                          'otheruser', b'tx1')
+        self.assertRaises(ValueError, self.store.retrieve,
+                          self.client_id + 1, 'foouser', b'tx1')
+        self.assertEqual(
+            self.store.retrieve(self.client_id, 'foouser', b'tx1'), '{}')
+
+    def test_max_transactions(self):
+        for i in range(5):
+            self.store.store(self.client_id, 'foouser', b'tx%d' % i, '{}')
+        self.store.store(self.client_id, 'otheruser', b'other', '{}')
+        self.assertEqual(Transaction.query.count(), 4)
+        for i in range(2):
+            self.assertRaises(ValueError, self.store.retrieve,
+                              self.client_id, 'foouser', b'tx%d' % i)
+        for i in range(2, 5):
+            self.store.retrieve(self.client_id, 'foouser', b'tx%d' % i)
+
+    def test_expired(self):
+        self.store.store(self.client_id, 'foouser', b'tx1', '{}')
+        Transaction.query.update(
+            {Transaction.created_at: datetime.utcnow() - timedelta(hours=1)})
+        db.session.commit()
+        self.assertRaises(ValueError, self.store.retrieve, self.client_id,
+                          'foouser', b'tx1')
+        self.assertEqual(Transaction.query.count(), 0)
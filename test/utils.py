@@ -0,0 +1,34 @@
+from u2fval.model import db
+from sqlalchemy import event
+from contextlib import contextmanager
+
+
+@contextmanager
+def count_queries():
+    """Counts the SQL statements executed within the block.
+
+    Yields a list which the executed statements are appended to.
+    """
+    statements = []
+
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_execute)
+
+
+class QueryBudgetMixin(object):
+    """Mixin for TestCases, for asserting the number of SQL statements."""
+
+    @contextmanager
+    def assertMaxQueries(self, n):
+        with count_queries() as statements:
+            yield statements
+        if len(statements) > n:
+            self.fail('%d SQL statements executed, expected at most %d:\n%s' %
+                      (len(statements), n, '\n'.join(statements)))
@@ -56,3 +56,4 @@ if db_conn is not None:
 
 import u2fval.view  # noqa
 import u2fval.model  # noqa
+import u2fval.profiler  # noqa
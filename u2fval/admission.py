@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+from . import app, exc
+from .metrics import enabled as metrics_enabled, metrics
+from .ratelimit import client_name
+from flask import g, request
+from timeit import default_timer as timer
+import threading
+
+
+class Limiter(object):
+    """Limits the number of requests handled concurrently.
+
+    Requests over the limit wait, for at most timeout seconds, for another
+    request to finish. No more than queue_size requests may wait at a time,
+    requests arriving when the queue is full are rejected immediately. To
+    keep a single client from starving others, no client may hold more than
+    client_limit of the slots while other clients are active or waiting. A
+    client alone may use all of them.
+    """
+
+    def __init__(self, limit, queue_size=0, timeout=0, client_limit=None):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.client_limit = client_limit or limit
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._clients = {}
+        self._waiting_clients = {}
+
+    def _has_slot(self, client):
+        if self._active >= self.limit:
+            return False
+        held = self._clients.get(client, 0)
+        if held < self.client_limit:
+            return True
+        others_waiting = self._waiting - self._waiting_clients.get(client, 0)
+        return self._active == held and others_waiting == 0
+
+    def acquire(self, client):
+        """Returns True if the request may proceed, False if rejected."""
+        with self._cond:
+            if not self._has_slot(client):
+                if self._waiting >= self.queue_size:
+                    return False
+                self._waiting += 1
+                self._waiting_clients[client] = \
+                    self._waiting_clients.get(client, 0) + 1
+                try:
+                    deadline = timer() + self.timeout
+                    while not self._has_slot(client):
+                        remaining = deadline - timer()
+                        if remaining <= 0:
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                    count = self._waiting_clients[client] - 1
+                    if count:
+                        self._waiting_clients[client] = count
+                    else:
+                        del self._waiting_clients[client]
+            self._active += 1
+            self._clients[client] = self._clients.get(client, 0) + 1
+            return True
+
+    def release(self, client):
+        with self._cond:
+            self._active -= 1
+            count = self._clients[client] - 1
+            if count:
+                self._clients[client] = count
+            else:
+                del self._clients[client]
+            self._cond.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def request_class():
+    """Returns 'complete' for completions of registrations and
+    authentications, which verify signatures and write to the database, and
+    for batch requests, which may write, and 'read' for all other requests.
+    """
+    if request.method == 'POST' and request.url_rule is not None and \
+            request.url_rule.endpoint in ('register', 'sign', 'batch'):
+        return 'complete'
+    return 'read'
+
+
+def get_limiter(name):
+    """Returns the Limiter for a request class, or None if unlimited."""
+    limit = (app.config.get('ADMISSION_LIMITS') or {}).get(name)
+    if limit is None:
+        return None
+    settings = (
+        name,
+        limit,
+        app.config.get('ADMISSION_QUEUE_SIZE', 0),
+        app.config.get('ADMISSION_QUEUE_TIMEOUT', 0),
+        max(1, int(limit * app.config.get('ADMISSION_CLIENT_SHARE', 1)))
+    )
+    with _limiters_lock:
+        limiter = _limiters.get(settings)
+        if limiter is None:
+            limiter = _limiters[settings] = Limiter(*settings[1:])
+    return limiter
+
+
+@app.before_request
+def _admit():
+    name = request_class()
+    limiter = get_limiter(name)
+    if limiter is None:
+        return
+    client = client_name()
+    if not limiter.acquire(client):
+        if metrics_enabled():
+            metrics.inc('u2fval_rejected_requests_total', [('class', name)])
+        raise exc.ServiceUnavailableException(
+            'Server overloaded, try again later',
+            app.config.get('ADMISSION_RETRY_AFTER', 1))
+    g.admission = (limiter, client)
+
+
+@app.teardown_request
+def _release(error=None):
+    admission = g.pop('admission', None)
+    if admission is not None:
+        limiter, client = admission
+        limiter.release(client)
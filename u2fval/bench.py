@@ -0,0 +1,226 @@
+from __future__ import absolute_import, division
+
+from .soft_u2f_v2 import SoftU2FDevice
+from six.moves import queue
+from six.moves.urllib.request import Request, urlopen
+from six.moves.urllib.error import HTTPError, URLError
+from base64 import b64encode
+from binascii import b2a_hex
+import threading
+import json
+import time
+import os
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. Slower
+# requests are counted in a final bucket with an upper bound of None.
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def percentile(sorted_values, p):
+    """Returns the p:th percentile of sorted_values, using nearest-rank."""
+    if not sorted_values:
+        return None
+    k = max(0, int(round(p / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+def summarize(latencies, elapsed=None):
+    """Summarizes a list of latencies, in seconds.
+
+    If elapsed (the wall clock time the latencies were collected over) is
+    given, it is used to calculate throughput, otherwise the requests are
+    assumed to have been made sequentially.
+    """
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    if elapsed is None:
+        elapsed = total
+    return {
+        'count': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else None,
+        'mean': total / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99)
+    }
+
+
+def histogram(latencies):
+    """Returns a list of (upper bound in ms, count) for latencies."""
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for latency in latencies:
+        ms = latency * 1000
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if ms <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return list(zip(HISTOGRAM_BUCKETS + [None], counts))
+
+
+class Stats(object):
+    """Thread safe collection of latencies and errors per operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, op, latency, error=None):
+        with self._lock:
+            self.latencies.setdefault(op, []).append(latency)
+            if error is not None:
+                errors = self.errors.setdefault(op, {})
+                errors[error] = errors.get(error, 0) + 1
+
+    def error_count(self, op):
+        return sum(self.errors.get(op, {}).values())
+
+
+class BenchError(ValueError):
+    pass
+
+
+class LoadGenerator(object):
+    """Runs synthetic register and sign flows against a u2fval server.
+
+    Clients are addressed either by path (for servers running in the
+    multi-client mode of "u2fval run"), or by HTTP basic authentication
+    without a password (for the debug server, or deployments where the web
+    server authenticates clients). With no clients given, the server is
+    assumed to be running in single-client mode.
+    """
+
+    def __init__(self, url, clients=None, client_from_path=False,
+                 users_per_client=10, keys_per_user=1, timeout=30):
+        self.url = url.rstrip('/')
+        self.clients = list(clients or [None])
+        self.client_from_path = client_from_path
+        self.users_per_client = users_per_client
+        self.keys_per_user = keys_per_user
+        self.timeout = timeout
+        self.stats = Stats()
+        self._run_id = b2a_hex(os.urandom(4)).decode('ascii')
+        self._facets = {}
+
+    def _request(self, client, path, op=None, data=None):
+        url = self.url
+        if client is not None and self.client_from_path:
+            url += '/' + client
+        req = Request(url + path)
+        if client is not None and not self.client_from_path:
+            req.add_header('Authorization', 'Basic ' + b64encode(
+                (client + ':').encode('utf8')).decode('ascii'))
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+            data = json.dumps(data).encode('utf8')
+
+        start = time.time()
+        error = None
+        try:
+            resp = urlopen(req, data, self.timeout)
+            body = resp.read()
+        except HTTPError as e:
+            body = e.read()
+            try:
+                error = 'HTTP %d (errorCode %s)' % (
+                    e.code, json.loads(body.decode('utf8'))['errorCode'])
+            except (ValueError, KeyError):
+                error = 'HTTP %d' % e.code
+        except (URLError, IOError) as e:
+            error = type(e).__name__
+        if op is not None:
+            self.stats.record(op, time.time() - start, error)
+        if error is not None:
+            raise BenchError(error)
+        return json.loads(body.decode('utf8'))
+
+    def _facet(self, client):
+        if client not in self._facets:
+            facets = self._request(client, '/')
+            self._facets[client] = facets['trustedFacets'][0]['ids'][0]
+        return self._facets[client]
+
+    def users(self):
+        for client in self.clients:
+            for i in range(self.users_per_client):
+                yield client, 'bench-%s-%d' % (self._run_id, i)
+
+    def register(self, client, user, device):
+        facet = self._facet(client)
+        for _ in range(self.keys_per_user):
+            reg_req = self._request(client, '/%s/register' % user,
+                                    'register_begin')
+            reg_resp = device.register(facet, reg_req['appId'],
+                                       reg_req['registerRequests'][0])
+            self._request(client, '/%s/register' % user, 'register_complete',
+                          {'registerResponse': reg_resp})
+
+    def sign(self, client, user, device):
+        facet = self._facet(client)
+        aut_req = self._request(client, '/%s/sign' % user, 'sign_begin')
+        key = aut_req['registeredKeys'][0]
+        aut_resp = device.getAssertion(facet, aut_req['appId'],
+                                       aut_req['challenge'], key)
+        self._request(client, '/%s/sign' % user, 'sign_complete',
+                      {'signResponse': aut_resp})
+
+    def _run_tasks(self, tasks, concurrency):
+        """Runs the callables in tasks using concurrency threads.
+
+        Returns the wall clock time taken.
+        """
+        q = queue.Queue()
+        for task in tasks:
+            q.put(task)
+
+        def worker():
+            while True:
+                try:
+                    task = q.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    task()
+                except BenchError:
+                    pass  # Recorded in stats.
+
+        start = time.time()
+        threads = [threading.Thread(target=worker)
+                   for _ in range(concurrency)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return time.time() - start
+
+    def run(self, concurrency=10, signs_per_user=10):
+        """Registers keys for all users, then runs sign flows.
+
+        Returns a dict of operation -> summary, including error counts,
+        throughput and latency histograms.
+        """
+        devices = dict((u, SoftU2FDevice()) for u in self.users())
+        for client in self.clients:
+            self._facet(client)  # Fail early if the server is unreachable.
+
+        elapsed = {}
+        elapsed['register'] = self._run_tasks(
+            [lambda u=u: self.register(u[0], u[1], devices[u])
+             for u in devices], concurrency)
+        # Signs for the same user run sequentially, to keep counters ordered.
+        elapsed['sign'] = self._run_tasks(
+            [lambda u=u: [self.sign(u[0], u[1], devices[u])
+                          for _ in range(signs_per_user)]
+             for u in devices], concurrency)
+
+        results = {}
+        for op, latencies in self.stats.latencies.items():
+            summary = summarize(latencies, elapsed[op.split('_')[0]])
+            summary['errors'] = self.stats.error_count(op)
+            summary['errorTypes'] = self.stats.errors.get(op, {})
+            summary['histogram'] = histogram(latencies)
+            results[op] = summary
+        return results
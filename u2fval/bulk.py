@@ -0,0 +1,464 @@
+from __future__ import absolute_import
+
+from .model import (db, Client, User, Certificate, Device, Property,
+                    Transaction, bump_versions, _calculate_fingerprint)
+from sqlalchemy import bindparam, exists, func
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from base64 import b64encode, b64decode
+from datetime import datetime
+import json
+
+
+def iter_chunks(query, column, chunk_size=1000):
+    """Yields the rows of query as lists, using keyset pagination on column.
+
+    Unlike OFFSET based paging this does not degrade as it progresses, and
+    unlike a single query with .all() only one chunk is held in memory.
+    """
+    last = None
+    while True:
+        q = query
+        if last is not None:
+            q = q.filter(column > last)
+        chunk = q.order_by(column).limit(chunk_size).all()
+        if not chunk:
+            return
+        yield chunk
+        last = getattr(chunk[-1], column.key)
+
+
+def delete_devices(device_ids):
+    """Deletes devices and their properties using set-based statements.
+
+    Child rows are deleted explicitly rather than relying on ON DELETE
+    CASCADE, so that this also works for databases created before the
+    foreign keys declared it. The caller is responsible for committing.
+    """
+    if not device_ids:
+        return 0
+    bump_versions(db.session.query(Device.user_id)
+                  .filter(Device.id.in_(device_ids)).subquery())
+    Property.query.filter(Property.device_id.in_(device_ids)) \
+        .delete(synchronize_session=False)
+    return Device.query.filter(Device.id.in_(device_ids)) \
+        .delete(synchronize_session=False)
+
+
+def delete_users(user_ids):
+    """Deletes users with all their devices, properties and transactions.
+
+    Like delete_devices, this uses a constant number of statements regardless
+    of how many rows are affected. The caller is responsible for committing.
+    """
+    if not user_ids:
+        return 0
+    devices = db.session.query(Device.id).filter(Device.user_id.in_(user_ids))
+    Property.query.filter(Property.device_id.in_(devices.subquery())) \
+        .delete(synchronize_session=False)
+    Device.query.filter(Device.user_id.in_(user_ids)) \
+        .delete(synchronize_session=False)
+    Transaction.query.filter(Transaction.user_id.in_(user_ids)) \
+        .delete(synchronize_session=False)
+    return User.query.filter(User.id.in_(user_ids)) \
+        .delete(synchronize_session=False)
+
+
+def purge_client(client, chunk_size=500):
+    """Deletes a client along with all of its users, in chunks.
+
+    Each chunk of users is deleted and committed in its own transaction to
+    avoid holding locks for a long time. Yields the total number of users
+    deleted after each chunk.
+    """
+    users = db.session.query(User.id).filter(User.client_id == client.id)
+    deleted = 0
+    for chunk in iter_chunks(users, User.id, chunk_size):
+        deleted += delete_users([u.id for u in chunk])
+        db.session.commit()
+        yield deleted
+    # Catch any users created while purging, and remove the client itself.
+    for user_ids in _in_chunks([user_id for (user_id,) in users]):
+        deleted += delete_users(user_ids)
+    Client.query.filter(Client.id == client.id) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    yield deleted
+
+
+def purge_stale(cutoff, client=None, chunk_size=500, dry_run=False):
+    """Deletes devices not used since cutoff, and users left without devices.
+
+    A device counts as used when it was last authenticated, or if it never
+    was, when it was registered. Candidates are selected in keyset chunks and
+    each chunk is deleted and committed in its own small transaction. Yields
+    a dict of the cumulative number of devices, properties and users deleted
+    (or that would be deleted, if dry_run is set) after each chunk.
+    """
+    last_used = func.coalesce(Device.authenticated_at, Device.created_at)
+    devices = db.session.query(Device.id, Device.user_id) \
+        .filter(last_used < cutoff)
+    if client is not None:
+        devices = devices.join(User, Device.user_id == User.id) \
+            .filter(User.client_id == client.id)
+
+    counts = dict.fromkeys(['devices', 'properties', 'users'], 0)
+    for chunk in iter_chunks(devices, Device.id, chunk_size):
+        device_ids = [d.id for d in chunk]
+        user_ids = list(set(d.user_id for d in chunk))
+        # Users with no devices left once this and earlier chunks are gone.
+        dormant = [user_id for (user_id,) in db.session.query(User.id)
+                   .filter(User.id.in_(user_ids))
+                   .filter(~exists().where(Device.user_id == User.id)
+                           .where((last_used >= cutoff) |
+                                  (Device.id > device_ids[-1])))
+                   .filter(~exists().where(Transaction.user_id == User.id))]
+        counts['properties'] += Property.query \
+            .filter(Property.device_id.in_(device_ids)).count()
+        if dry_run:
+            counts['devices'] += len(device_ids)
+            counts['users'] += len(dormant)
+        else:
+            counts['devices'] += delete_devices(device_ids)
+            if dormant:
+                counts['users'] += User.query \
+                    .filter(User.id.in_(dormant)) \
+                    .filter(~exists().where(Device.user_id == User.id)) \
+                    .filter(~exists().where(Transaction.user_id == User.id)) \
+                    .delete(synchronize_session=False)
+            db.session.commit()
+        yield counts
+
+
+def _fingerprint_der(der):
+    cert = x509.load_der_x509_certificate(der, default_backend())
+    return _calculate_fingerprint(cert)
+
+
+def recalc_fingerprints(start_after=None, chunk_size=1000, pool=None):
+    """Re-calculates the fingerprints of all certificates, in chunks.
+
+    Certificates are read in keyset chunks, hashed (using pool.map if a
+    multiprocessing pool is given), and any changed fingerprints are written
+    and committed before moving on to the next chunk. Yields a tuple of
+    (last certificate id, certificates in chunk, certificates changed) per
+    chunk, which allows resuming by passing the id as start_after.
+    """
+    certs = db.session.query(Certificate.id, Certificate.fingerprint,
+                             Certificate._der)
+    if start_after is not None:
+        certs = certs.filter(Certificate.id > start_after)
+    table = Certificate.__table__
+    update = table.update().where(table.c.id == bindparam('_id'))
+    for chunk in iter_chunks(certs, Certificate.id, chunk_size):
+        ders = [b64decode(c._der) for c in chunk]
+        if pool is not None:
+            fingerprints = pool.map(_fingerprint_der, ders)
+        else:
+            fingerprints = [_fingerprint_der(der) for der in ders]
+        changed = [{'_id': c.id, 'fingerprint': fp}
+                   for c, fp in zip(chunk, fingerprints)
+                   if fp != c.fingerprint]
+        if changed:
+            db.session.execute(update, changed)
+        db.session.commit()
+        yield chunk[-1].id, len(chunk), len(changed)
+
+
+def _format_datetime(value):
+    if value is not None:
+        return value.isoformat() + 'Z'
+
+
+def _parse_datetime(value):
+    if value is None:
+        return None
+    value = value.rstrip('Z')
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+    return value
+
+
+def export_records(clients, chunk_size=500):
+    """Yields NDJSON records for the given clients and all of their data.
+
+    Certificates are emitted first, once per fingerprint, followed by each
+    client with its users and devices. Devices carry their properties inline
+    and reference their user and certificate by name and fingerprint.
+    """
+    client_ids = [c.id for c in clients]
+
+    used_certs = db.session.query(Device.certificate_id) \
+        .join(User, Device.user_id == User.id) \
+        .filter(User.client_id.in_(client_ids))
+    certs = db.session.query(Certificate.id, Certificate.fingerprint,
+                             Certificate._der) \
+        .filter(Certificate.id.in_(used_certs))
+    for chunk in iter_chunks(certs, Certificate.id, chunk_size):
+        for cert in chunk:
+            yield {
+                'type': 'certificate',
+                'fingerprint': cert.fingerprint,
+                'der': _text(cert._der)
+            }
+
+    for client in clients:
+        yield {
+            'type': 'client',
+            'name': client.name,
+            'appId': client.app_id,
+            'facets': client.valid_facets
+        }
+
+        users = db.session.query(User.name) \
+            .filter(User.client_id == client.id) \
+            .order_by(User.id).yield_per(chunk_size)
+        for user in users:
+            yield {
+                'type': 'user',
+                'client': client.name,
+                'name': user.name
+            }
+
+        devices = db.session.query(
+            Device.id, Device.handle, Device.bind_data, Device.compromised,
+            Device.created_at, Device.authenticated_at, Device.counter,
+            Device.transports, User.name.label('user_name'),
+            Certificate.fingerprint
+        ).join(User, Device.user_id == User.id) \
+            .join(Certificate, Device.certificate_id == Certificate.id) \
+            .filter(User.client_id == client.id)
+        for chunk in iter_chunks(devices, Device.id, chunk_size):
+            properties = {}
+            for prop in db.session.query(Property.device_id, Property.key,
+                                         Property.value) \
+                    .filter(Property.device_id.in_([d.id for d in chunk])):
+                properties.setdefault(prop.device_id, {})[prop.key] = \
+                    prop.value
+            for dev in chunk:
+                yield {
+                    'type': 'device',
+                    'client': client.name,
+                    'user': dev.user_name,
+                    'handle': dev.handle,
+                    'bindData': dev.bind_data,
+                    'certificate': dev.fingerprint,
+                    'compromised': bool(dev.compromised),
+                    'created': _format_datetime(dev.created_at),
+                    'lastUsed': _format_datetime(dev.authenticated_at),
+                    'counter': dev.counter,
+                    'transports': dev.transports,
+                    'properties': properties.get(dev.id, {})
+                }
+
+
+def _in_chunks(values, size=500):
+    # Keeps IN clauses below the bind parameter limit of SQLite.
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def upsert_clients(clients):
+    """Creates or updates clients from a list of (name, app_id, facets).
+
+    Returns a tuple of (created, updated). The caller is responsible for
+    committing the session.
+    """
+    existing = set()
+    for names in _in_chunks([c[0] for c in clients]):
+        existing.update(name for (name,) in db.session.query(Client.name)
+                        .filter(Client.name.in_(names)))
+
+    table = Client.__table__
+    inserts = [{'name': name, 'app_id': app_id,
+                'valid_facets': json.dumps(facets)}
+               for name, app_id, facets in clients if name not in existing]
+    updates = [{'_name': name, 'app_id': app_id,
+                'valid_facets': json.dumps(facets)}
+               for name, app_id, facets in clients if name in existing]
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    if updates:
+        # The version is not bumped automatically outside of the ORM.
+        db.session.execute(
+            table.update().where(table.c.name == bindparam('_name'))
+            .values(version=table.c.version + 1),
+            updates)
+    return len(inserts), len(updates)
+
+
+def write_ndjson(records, fp):
+    count = 0
+    for record in records:
+        fp.write(json.dumps(record, sort_keys=True))
+        fp.write('\n')
+        count += 1
+    return count
+
+
+class Importer(object):
+    """Inserts NDJSON records produced by export_records, in batches.
+
+    Records which already exist in the database (clients and users by name,
+    certificates by fingerprint, devices by handle) are skipped, which makes
+    it safe to re-run an import which was interrupted.
+    """
+
+    def __init__(self):
+        self._client_ids = {}
+        self.created = dict.fromkeys(
+            ['client', 'certificate', 'user', 'device', 'property'], 0)
+        self.skipped = 0
+
+    def _client_id(self, name):
+        client_id = self._client_ids.get(name)
+        if client_id is None:
+            client_id = db.session.query(Client.id) \
+                .filter(Client.name == name).scalar()
+            if client_id is None:
+                raise ValueError('Unknown client: %s' % name)
+            self._client_ids[name] = client_id
+        return client_id
+
+    def _import_clients(self, records):
+        for record in records:
+            if db.session.query(Client.id) \
+                    .filter(Client.name == record['name']).scalar():
+                self.skipped += 1
+                continue
+            db.session.add(Client(record['name'], record['appId'],
+                                  record['facets']))
+            db.session.flush()
+            self.created['client'] += 1
+
+    def _import_certificates(self, records):
+        by_fp = dict((r['fingerprint'], r) for r in records)
+        if not by_fp:
+            return
+        existing = set()
+        for fps in _in_chunks(list(by_fp)):
+            existing.update(fp for (fp,) in db.session.query(
+                Certificate.fingerprint)
+                .filter(Certificate.fingerprint.in_(fps)))
+        rows = [{
+            'fingerprint': fp,
+            # Round-trip to validate the encoding.
+            'der': b64encode(b64decode(r['der'])).decode('ascii')
+        } for fp, r in by_fp.items() if fp not in existing]
+        self.skipped += len(records) - len(rows)
+        if rows:
+            db.session.execute(Certificate.__table__.insert(), rows)
+            self.created['certificate'] += len(rows)
+
+    def _find_users(self, keys):
+        user_ids = {}
+        by_client = {}
+        for client_id, name in keys:
+            by_client.setdefault(client_id, set()).add(name)
+        for client_id, names in by_client.items():
+            for chunk in _in_chunks(list(names)):
+                for user_id, name in db.session.query(User.id, User.name) \
+                        .filter(User.client_id == client_id) \
+                        .filter(User.name.in_(chunk)):
+                    user_ids[(client_id, name)] = user_id
+        return user_ids
+
+    def _user_ids(self, keys):
+        """Returns a dict of (client_id, name) -> user id, creating users."""
+        user_ids = self._find_users(keys)
+        missing = [k for k in keys if k not in user_ids]
+        if missing:
+            db.session.execute(User.__table__.insert(), [
+                {'client_id': client_id, 'name': name}
+                for client_id, name in missing
+            ])
+            self.created['user'] += len(missing)
+            user_ids.update(self._find_users(missing))
+        return user_ids
+
+    def _import_users(self, records):
+        keys = set((self._client_id(r['client']), r['name'])
+                   for r in records)
+        created = self.created['user']
+        self._user_ids(keys)
+        self.skipped += len(keys) - (self.created['user'] - created)
+
+    def _import_devices(self, records):
+        if not records:
+            return
+        existing = set()
+        for handles in _in_chunks([r['handle'] for r in records]):
+            existing.update(h for (h,) in db.session.query(Device.handle)
+                            .filter(Device.handle.in_(handles)))
+        records = [r for r in records if r['handle'] not in existing]
+        self.skipped += len(existing)
+        if not records:
+            return
+
+        user_ids = self._user_ids(set(
+            (self._client_id(r['client']), r['user']) for r in records))
+        fingerprints = set(r['certificate'] for r in records)
+        cert_ids = {}
+        for fps in _in_chunks(list(fingerprints)):
+            cert_ids.update(db.session.query(Certificate.fingerprint,
+                                             Certificate.id)
+                            .filter(Certificate.fingerprint.in_(fps)))
+        missing = fingerprints.difference(cert_ids)
+        if missing:
+            raise ValueError('Unknown certificate: %s' % missing.pop())
+
+        device_users = [user_ids[(self._client_id(r['client']), r['user'])]
+                        for r in records]
+        bump_versions(list(set(device_users)))
+        db.session.execute(Device.__table__.insert(), [{
+            'handle': r['handle'],
+            'user_id': user_id,
+            'bind_data': r['bindData'],
+            'certificate_id': cert_ids[r['certificate']],
+            'compromised': r.get('compromised', False),
+            'created_at': _parse_datetime(r.get('created')) or
+            datetime.utcnow(),
+            'authenticated_at': _parse_datetime(r.get('lastUsed')),
+            'counter': r.get('counter'),
+            'transports': r.get('transports', 0)
+        } for r, user_id in zip(records, device_users)])
+        self.created['device'] += len(records)
+
+        device_ids = {}
+        for handles in _in_chunks([r['handle'] for r in records]):
+            device_ids.update(db.session.query(Device.handle, Device.id)
+                              .filter(Device.handle.in_(handles)))
+        properties = [{
+            'device_id': device_ids[r['handle']],
+            'key': k,
+            'value': v
+        } for r in records for k, v in r.get('properties', {}).items()]
+        if properties:
+            db.session.execute(Property.__table__.insert(), properties)
+            self.created['property'] += len(properties)
+
+    def import_batch(self, records):
+        """Imports a list of records and commits them as one transaction."""
+        by_type = dict((t, []) for t in
+                       ['client', 'certificate', 'user', 'device'])
+        for record in records:
+            try:
+                by_type[record['type']].append(record)
+            except KeyError:
+                raise ValueError('Invalid record type: %s' %
+                                 record.get('type'))
+        try:
+            self._import_clients(by_type['client'])
+            self._import_certificates(by_type['certificate'])
+            self._import_users(by_type['user'])
+            self._import_devices(by_type['device'])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
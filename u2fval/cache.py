@@ -0,0 +1,35 @@
+from __future__ import absolute_import
+
+from . import app
+from werkzeug.contrib.cache import SimpleCache, MemcachedCache
+from hashlib import sha256
+
+
+if app.config['USE_MEMCACHED']:
+    cache = MemcachedCache(app.config['MEMCACHED_SERVERS'])
+else:
+    cache = SimpleCache()
+
+
+def _missing_user_key(client_id, name):
+    return 'missing_user/%d/%s' % (
+        client_id, sha256(name.encode('utf8')).hexdigest())
+
+
+def is_missing_user(client_id, name):
+    """Checks if a user is known not to exist."""
+    if not app.config.get('MISSING_USER_CACHE_TTL'):
+        return False
+    return cache.get(_missing_user_key(client_id, name)) is not None
+
+
+def set_missing_user(client_id, name):
+    ttl = app.config.get('MISSING_USER_CACHE_TTL')
+    if ttl:
+        cache.set(_missing_user_key(client_id, name), 1, timeout=ttl)
+
+
+def forget_missing_user(client_id, name):
+    """Must be called when a user is created."""
+    if app.config.get('MISSING_USER_CACHE_TTL'):
+        cache.delete(_missing_user_key(client_id, name))
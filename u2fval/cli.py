@@ -4,10 +4,20 @@ from wsgiref.simple_server import make_server
 from werkzeug.exceptions import NotFound
 from werkzeug.wsgi import pop_path_info
 from . import app
-from .model import db, Client
+from .model import db, Client, Certificate, upgrade_schema
+from .bench import LoadGenerator, HISTOGRAM_BUCKETS
+from .synthetic import Generator
+from .metrics import is_metrics_request
+from .bulk import (export_records, write_ndjson, upsert_clients, purge_client,
+                   purge_stale, recalc_fingerprints, Importer)
 from six.moves.urllib_parse import urlparse
+from datetime import datetime, timedelta
+import csv
+import json
+import multiprocessing
 import os
 import re
+import six
 import sys
 import click
 
@@ -59,6 +69,115 @@ def init():
     click.echo('Database initialized!')
 
 
+@database.command()
+def upgrade():
+    """Adds tables and columns missing from an existing database."""
+    added = upgrade_schema()
+    if added:
+        click.echo('Added columns: %s' % ', '.join(added))
+    click.echo('Database upgraded!')
+
+
+@database.command()
+@click.option('--clients', default=1, help='number of clients to create')
+@click.option('--users', default=1000, help='users to create per client')
+@click.option('--devices', default=2, help='devices to create per user')
+@click.option('--properties', default=2,
+              help='properties to set per device (at most 5)')
+@click.option('--transactions', default=0.01,
+              help='fraction of users with a transaction in progress')
+@click.option('--seed', default=0, help='seed for the random generator')
+@click.option('--prefix', default='synthetic',
+              help='prefix for the names of the created clients')
+@click.option('--batch-size', default=5000,
+              help='number of users to insert per transaction')
+def generate(clients, users, devices, properties, transactions, seed,
+             prefix, batch_size):
+    """
+    Fills the database with synthetic data
+
+    Creates clients named PREFIX-N, each with users that have registered
+    devices. Intended for scale testing, do not use on a production database!
+    The data is generated deterministically from the seed.
+    """
+    generator = Generator(seed, devices, properties, transactions,
+                          batch_size)
+    with click.progressbar(length=clients * users * devices,
+                           label='Devices') as bar:
+        created = 0
+        for total in generator.generate(clients, users, prefix):
+            bar.update(total - created)
+            created = total
+    click.echo('Created %d clients with %d users and %d devices.' % (
+        clients, clients * users, created))
+
+
+@database.command('recalc-fingerprints')
+@click.confirmation_option(prompt='Re-calculate certificate fingerprints?')
+@click.option('-w', '--workers', default=multiprocessing.cpu_count(),
+              help='number of worker processes to use for hashing')
+@click.option('--chunk-size', default=1000,
+              help='number of certificates to update per transaction')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='file to record progress in, allowing an interrupted run '
+              'to be resumed')
+def recalc_fingerprints_cmd(workers, chunk_size, checkpoint):
+    """Re-calculates fingerprints for all certificates"""
+    start_after = None
+    if checkpoint and os.path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            start_after = int(f.read().strip())
+        click.echo('Resuming after certificate %d' % start_after, err=True)
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    remaining = Certificate.query
+    if start_after is not None:
+        remaining = remaining.filter(Certificate.id > start_after)
+    changed = total = 0
+    try:
+        with click.progressbar(length=remaining.count(),
+                               label='Certificates') as bar:
+            for last_id, n, n_changed in recalc_fingerprints(
+                    start_after, chunk_size, pool):
+                total += n
+                changed += n_changed
+                if checkpoint:
+                    with open(checkpoint, 'w') as f:
+                        f.write('%d\n' % last_id)
+                bar.update(n)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    click.echo('Success! %d/%d certificates were modified.' % (changed, total))
+
+
+@database.command('purge-stale')
+@click.option('--unused-since', 'days', type=int, required=True,
+              help='delete devices which have not been used for DAYS days')
+@click.option('-c', '--client', help='only purge devices for CLIENT')
+@click.option('--dry-run', is_flag=True,
+              help='report what would be deleted without deleting anything')
+@click.option('--chunk-size', default=500,
+              help='number of devices to delete per transaction')
+def purge_stale_devices(days, client, dry_run, chunk_size):
+    """
+    Deletes devices which have not been used in a long time
+
+    A device which has never authenticated is considered used when it was
+    registered. Users which are left without any devices are deleted as well.
+    """
+    c = None
+    if client:
+        c = Client.query.filter(Client.name == client).one()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    counts = dict.fromkeys(['devices', 'properties', 'users'], 0)
+    for counts in purge_stale(cutoff, c, chunk_size, dry_run):
+        click.echo('Processed %d devices...' % counts['devices'], err=True)
+    click.echo('%s %d devices, %d properties and %d users.' % (
+        'Would delete' if dry_run else 'Deleted', counts['devices'],
+        counts['properties'], counts['users']))
+
+
 @cli.group()
 def client():
     pass
@@ -126,17 +245,195 @@ def update(ctx, name, appid, facets):
 
 
 @client.command()
+@click.option('--chunk-size', default=500,
+              help='number of users to delete per transaction')
 @click.argument('name')
-def delete(name):
-    """Deletes a client"""
+def delete(chunk_size, name):
+    """
+    Deletes a client
+
+    All users and devices belonging to the client are deleted as well, a chunk
+    of users at a time.
+    """
     c = Client.query.filter(Client.name == name).one()
-    db.session.delete(c)
+    deleted = 0
+    for deleted in purge_client(c, chunk_size):
+        click.echo('Deleted %d users...' % deleted, err=True)
+    click.echo('Client deleted: %s (%d users)' % (name, deleted))
+
+
+def _file_format(fmt, fp):
+    if fmt is None:
+        fmt = 'csv' if fp.name.lower().endswith('.csv') else 'json'
+    return fmt
+
+
+@client.command('import')
+@click.pass_context
+@click.option('-f', '--format', 'fmt', type=click.Choice(['json', 'csv']),
+              help='file format, defaults to csv for .csv files and json '
+              'otherwise')
+@click.argument('input', type=click.File('r'))
+def import_clients(ctx, fmt, input):
+    """
+    Create or update clients from a file
+
+    A JSON file should contain a list of objects with "name", "appId" and
+    (optionally) "facets". A CSV file should have the columns name, appId and
+    facets, with multiple facets separated by spaces. Existing clients are
+    updated. All entries are validated before any changes are made.
+    """
+    if _file_format(fmt, input) == 'csv':
+        entries = [{
+            'name': row.get('name'),
+            'appId': row.get('appId'),
+            'facets': (row.get('facets') or '').split()
+        } for row in csv.DictReader(input)]
+    else:
+        entries = json.load(input)
+        if not isinstance(entries, list):
+            raise ValueError('Expected a list of clients')
+
+    clients = []
+    seen = set()
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError('Entry %d: not an object' % (i + 1))
+        name, appid = entry.get('name'), entry.get('appId')
+        if not name or not appid:
+            raise ValueError('Entry %d: each client requires a name and an '
+                             'appId' % (i + 1))
+        if not isinstance(name, six.string_types) or \
+                not isinstance(appid, six.string_types):
+            raise ValueError('Entry %d: name and appId must be strings' %
+                             (i + 1))
+        if name in seen:
+            raise ValueError('Duplicate client: %s' % name)
+        seen.add(name)
+        facets = entry.get('facets')
+        if facets is not None and (not isinstance(facets, list) or not all(
+                isinstance(f, six.string_types) for f in facets)):
+            raise ValueError('%s: facets must be a list of strings' % name)
+        try:
+            ensure_valid_name(name)
+            facets = _get_facets(ctx, appid, facets)
+        except ValueError as e:
+            raise ValueError('%s: %s' % (name, e))
+        except click.UsageError as e:
+            ctx.fail('%s: %s' % (name, e.message))
+        clients.append((name, appid, facets))
+
+    created, updated = upsert_clients(clients)
     db.session.commit()
-    click.echo('Client deleted: %s' % name)
+    click.echo('Clients created: %d, updated: %d' % (created, updated))
+
+
+@client.command('export')
+@click.option('-f', '--format', 'fmt', type=click.Choice(['json', 'csv']),
+              help='file format, defaults to csv for .csv files and json '
+              'otherwise')
+@click.argument('output', type=click.File('w'), default='-')
+def export_clients(fmt, output):
+    """
+    Write all clients to a file
+
+    The output can be read by "client import".
+    """
+    clients = Client.query.order_by(Client.name).all()
+    if _file_format(fmt, output) == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(['name', 'appId', 'facets'])
+        for c in clients:
+            writer.writerow([c.name, c.app_id, ' '.join(c.valid_facets)])
+    else:
+        json.dump([{
+            'name': c.name,
+            'appId': c.app_id,
+            'facets': c.valid_facets
+        } for c in clients], output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+@cli.group()
+def data():
+    pass
+
+
+@data.command('export')
+@click.option('-c', '--client', 'clients', multiple=True,
+              help='client to export (can be given multiple times), '
+              'defaults to all clients')
+@click.option('--chunk-size', default=500, help='rows to read per query')
+@click.argument('output', type=click.File('w'), default='-')
+def export_data(clients, chunk_size, output):
+    """
+    Export users and devices as NDJSON
+
+    Writes one JSON record per line to OUTPUT (defaults to stdout).
+    """
+    query = Client.query.order_by(Client.id)
+    if clients:
+        query = query.filter(Client.name.in_(clients))
+    selected = query.all()
+    missing = set(clients).difference(c.name for c in selected)
+    if missing:
+        raise ValueError('Client not found: %s' % ', '.join(sorted(missing)))
+    count = write_ndjson(export_records(selected, chunk_size), output)
+    click.echo('Exported %d records' % count, err=True)
+
+
+@data.command('import')
+@click.option('--batch-size', default=500,
+              help='records to insert per transaction')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='file to record progress in, allowing an interrupted '
+              'import to be resumed')
+@click.argument('input', type=click.File('r'), default='-')
+def import_data(batch_size, checkpoint, input):
+    """
+    Import users and devices from NDJSON
+
+    Reads records created by "data export" from INPUT (defaults to stdin).
+    Records that already exist are skipped.
+    """
+    skip = 0
+    if checkpoint and os.path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            skip = int(f.read().strip() or 0)
+        click.echo('Resuming after line %d' % skip, err=True)
+
+    importer = Importer()
+    batch = []
+    line_no = 0
+
+    def flush():
+        importer.import_batch(batch)
+        del batch[:]
+        if checkpoint:
+            with open(checkpoint, 'w') as f:
+                f.write('%d\n' % line_no)
+
+    for line_no, line in enumerate(input, 1):
+        if line_no <= skip or not line.strip():
+            continue
+        try:
+            batch.append(json.loads(line))
+        except ValueError:
+            raise ValueError('Invalid JSON on line %d' % line_no)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    click.echo('Imported %s, skipped %d existing records' % (
+        ', '.join('%d %ss' % (importer.created[k], k) for k in
+                  ['client', 'certificate', 'user', 'device', 'property']),
+        importer.skipped), err=True)
 
 
 def client_from_path(app):
     def inner(environ, start_response):
+        if is_metrics_request(environ):
+            return app(environ, start_response)
         client_name = pop_path_info(environ)
         if not client_name:
             return NotFound()(environ, start_response)
@@ -179,6 +476,53 @@ def run(interface, port, client, debug):
     return httpd.serve_forever()
 
 
+@cli.command()
+@click.argument('url')
+@click.option('-n', '--concurrency', default=10,
+              help='number of concurrent requests')
+@click.option('-c', '--client', 'clients', multiple=True,
+              help='client to use (can be given multiple times), omit for a '
+              'server in single client mode')
+@click.option('--client-from-path', is_flag=True,
+              help='specify the client in the URL path, as used by the '
+              'multi-client mode of "u2fval run", rather than by HTTP basic '
+              'authentication')
+@click.option('-u', '--users', default=10, help='users per client')
+@click.option('-k', '--keys', default=1, help='keys to register per user')
+@click.option('-s', '--signs', default=10,
+              help='authentications to perform per user')
+@click.option('-o', '--output', type=click.File('w'),
+              help='file to write the results to, as JSON')
+def bench(url, concurrency, clients, client_from_path, users, keys, signs,
+          output):
+    """
+    Runs a load test against a U2FVAL server
+
+    Registers KEYS soft U2F devices for USERS new users of each client, then
+    performs SIGNS authentications per user, against the server at URL.
+    """
+    generator = LoadGenerator(url, clients, client_from_path, users, keys)
+    results = generator.run(concurrency, signs)
+    for op in ['register_begin', 'register_complete', 'sign_begin',
+               'sign_complete']:
+        if op not in results:
+            continue
+        r = results[op]
+        click.echo('%s: %d requests, %d errors, %.1f req/s, '
+                   'p50/p95/p99: %.1f/%.1f/%.1f ms' % (
+                       op, r['count'], r['errors'], r['rps'],
+                       r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000))
+        for error, count in sorted(r['errorTypes'].items()):
+            click.echo('  %s: %d' % (error, count))
+        for bound, count in r['histogram']:
+            if count:
+                click.echo('  %s ms: %d' % (
+                    '<= %5d' % bound if bound is not None
+                    else ' > %5d' % HISTOGRAM_BUCKETS[-1], count))
+    if output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+
 def main():
     try:
         cli(obj={})
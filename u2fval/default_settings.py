@@ -4,9 +4,12 @@
 DEBUG = True
 TESTING = True
 
-# Set to False to disable pretty-printing of JSON responses.
-# Note: XMLHttpRequests are never pretty-printed.
-JSONIFY_PRETTYPRINT_REGULAR = True
+# Set to True to pretty-print JSON responses, for debugging.
+JSONIFY_PRETTYPRINT_REGULAR = False
+
+# The library used for encoding and decoding JSON: 'orjson', 'ujson', 'json'
+# (the Python standard library) or 'auto' for the fastest one installed.
+JSON_BACKEND = 'auto'
 
 # Database configuration
 SQLALCHEMY_DATABASE_URI = 'sqlite://'
@@ -25,3 +28,97 @@ METADATA = '/etc/yubico/u2fval/metadata/'
 # Allow the use of untrusted (for which attestation cannot be verified using
 # the available trusted metadata) U2F devices.
 ALLOW_UNTRUSTED = False
+
+# Cache the registered keys and descriptors of the devices of each user for
+# this many seconds, to avoid loading all devices for each request. The cache
+# is keyed on a version of the user, which is changed in the database
+# whenever a device changes, so entries are never out of date. Set to 0 to
+# disable.
+USER_KEYS_CACHE_TTL = 600
+
+# Allow the trusted facets list of a client to be cached by the requester for
+# this many seconds, using a Cache-Control header. Responses also carry an
+# ETag, which changes whenever the client is updated. Set to None to omit the
+# header.
+TRUSTED_FACETS_MAX_AGE = 300
+
+# The maximum number of operations in a single request to the /batch endpoint.
+BATCH_MAX_OPERATIONS = 100
+
+# Remember users which don't exist for this many seconds, to avoid database
+# lookups for repeated requests for unknown users (e.g. enumeration attempts).
+# The cache is invalidated when a user is created, but only in the process
+# creating it unless USE_MEMCACHED is True, so other processes may consider
+# a new user unknown until the entry expires. Set to 0 to disable.
+MISSING_USER_CACHE_TTL = 0
+
+# Rate limit requests per client, and per user of each client, using token
+# buckets given as (tokens per second, bucket size), e.g.:
+#   RATE_LIMIT_CLIENT = (100, 200)
+#   RATE_LIMIT_USER = (1, 10)
+# Limits can be overridden per client name:
+#   RATE_LIMITS = {'myclient': {'client': (500, 1000), 'user': None}}
+# Rejected requests get a 429 response with a Retry-After header, without
+# accessing the database. Limits are kept per process, unless
+# RATE_LIMIT_STORAGE is set to 'memcached' (requires USE_MEMCACHED), which
+# shares them between processes.
+RATE_LIMIT_CLIENT = None
+RATE_LIMIT_USER = None
+RATE_LIMITS = {}
+RATE_LIMIT_STORAGE = 'memory'
+
+# Limit the number of requests handled concurrently by each process, to shed
+# load instead of queuing on the database and crypto when overloaded. Limits
+# are given per class of request: 'complete' for completing registrations and
+# authentications and for batch requests, 'read' for everything else, e.g.:
+#   ADMISSION_LIMITS = {'read': 40, 'complete': 8}
+# Requests over the limit wait at most ADMISSION_QUEUE_TIMEOUT seconds, with
+# at most ADMISSION_QUEUE_SIZE requests waiting per class. While other clients
+# are active or waiting, a single client can use at most ADMISSION_CLIENT_SHARE
+# of the limit. Rejected requests get a 503 response with a Retry-After header
+# of ADMISSION_RETRY_AFTER seconds.
+ADMISSION_LIMITS = None
+ADMISSION_QUEUE_SIZE = 20
+ADMISSION_QUEUE_TIMEOUT = 0.5
+ADMISSION_CLIENT_SHARE = 0.5
+ADMISSION_RETRY_AFTER = 1
+
+# Set to True to add a Server-Timing header to each response, with the time
+# spent in each phase of handling the request (client and user lookup,
+# transaction storage, crypto, metadata lookup and JSON serialization) and the
+# number of SQL statements executed. This is always done in debug mode.
+SERVER_TIMING = False
+
+# Log requests taking longer than this many seconds (e.g. 0.2) as JSON, with
+# details about the request such as the number of SQL statements executed and
+# the time spent in each phase. Slow requests are logged to the 'u2fval.slow'
+# logger, separately from other log messages, and written to SLOW_REQUEST_LOG
+# if set, or to stderr. Set to None to disable.
+SLOW_REQUEST_THRESHOLD = None
+SLOW_REQUEST_LOG = None
+
+# Serve metrics in the Prometheus text format at this path, e.g. '/metrics'.
+# The metrics endpoint does not require a client, and shadows any user with
+# the same name. Access to it should be restricted by the web server.
+# Set to None to disable metrics collection.
+METRICS_PATH = None
+
+# When running multiple worker processes (e.g. mod_wsgi or uWSGI), set this to
+# a directory writable by all workers (and cleared when the server starts) to
+# have the metrics endpoint report the totals of all processes. Each process
+# writes its values to this directory at most every METRICS_FLUSH_INTERVAL
+# seconds.
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+
+# Profile a sample of requests with cProfile, writing aggregated statistics as
+# pstats files to PROFILE_DIR at most every PROFILE_FLUSH_INTERVAL seconds.
+# PROFILE_SAMPLE_RATE is the fraction of requests to profile (0 to 1).
+# Requests with an X-U2fval-Profile header matching PROFILE_TOKEN are always
+# profiled. Set PROFILE_TRACEMALLOC to True to also write tracemalloc
+# snapshots (Python 3 only). Set PROFILE_DIR to None to disable.
+PROFILE_DIR = None
+PROFILE_SAMPLE_RATE = 0
+PROFILE_TOKEN = None
+PROFILE_FLUSH_INTERVAL = 60
+PROFILE_TRACEMALLOC = False
@@ -29,7 +29,9 @@ __all__ = [
     'U2fException',
     'BadInputException',
     'NoEligibleDevicesException',
-    'DeviceCompromisedException'
+    'DeviceCompromisedException',
+    'ServiceUnavailableException',
+    'TooManyRequestsException'
 ]
 
 
@@ -57,3 +59,21 @@ class NoEligibleDevicesException(U2fException):
 
 class DeviceCompromisedException(U2fException):
     code = 12
+
+
+class ServiceUnavailableException(U2fException):
+    status_code = 503
+    code = 13
+
+    def __init__(self, message, retry_after):
+        super(ServiceUnavailableException, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class TooManyRequestsException(U2fException):
+    status_code = 429
+    code = 14
+
+    def __init__(self, message, retry_after):
+        super(TooManyRequestsException, self).__init__(message)
+        self.retry_after = retry_after
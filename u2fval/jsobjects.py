@@ -36,6 +36,19 @@ __all__ = [
 ]
 
 
+def cached_property(func):
+    """Like property, but only calls func once per instance."""
+    name = '_cached_' + func.__name__
+
+    def getter(self):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            value = self.__dict__[name] = func(self)
+            return value
+    return property(getter, doc=func.__doc__)
+
+
 class WithProps(object):
 
     @property
@@ -50,41 +63,66 @@ class WithDescriptors(object):
         return [JSONDict.wrap(x) for x in self['descriptors']]
 
 
+class _CachedRegisterResponse(RegisterResponse):
+    # The decoded values are used both when looking up the transaction and
+    # when verifying the response.
+    clientData = cached_property(RegisterResponse.clientData.fget)
+    challengeParameter = cached_property(
+        RegisterResponse.challengeParameter.fget)
+    registrationData = cached_property(RegisterResponse.registrationData.fget)
+
+
+class _CachedSignResponse(SignResponse):
+    clientData = cached_property(SignResponse.clientData.fget)
+    challengeParameter = cached_property(SignResponse.challengeParameter.fget)
+    signatureData = cached_property(SignResponse.signatureData.fget)
+
+
+class _ResponseData(JSONDict, WithProps):
+    """Base class for response data, which is accepted either as an object
+    with the response under _response_field (and optional properties), or
+    as the bare response.
+    """
+    _response_field = None
+    _response_class = None
+
+    @classmethod
+    def wrap(cls, data):
+        if isinstance(data, cls):
+            return data
+        if not isinstance(data, dict):
+            data = JSONDict(data)
+        if cls._response_field in data:
+            return cls(data)
+        return cls({cls._response_field: cls._response_class.wrap(data)})
+
+    def _get_response(self):
+        return self._response_class.wrap(self[self._response_field])
+
+
 class RegisterRequestData(U2fRegisterRequest, WithDescriptors):
     pass
 
 
-class RegisterResponseData(JSONDict, WithProps):
+class RegisterResponseData(_ResponseData):
     _required_fields = ['registerResponse']
+    _response_field = 'registerResponse'
+    _response_class = _CachedRegisterResponse
 
-    @property
+    @cached_property
     def registerResponse(self):
-        return RegisterResponse.wrap(self['registerResponse'])
-
-    @classmethod
-    def wrap(cls, data):
-        try:
-            return super(RegisterResponseData, cls).wrap(data)
-        except ValueError:
-            response = RegisterResponse.wrap(data)
-            return cls(registerResponse=response.json)
+        return self._get_response()
 
 
 class SignRequestData(U2fSignRequest, WithDescriptors):
     pass
 
 
-class SignResponseData(JSONDict, WithProps):
+class SignResponseData(_ResponseData):
     _required_fields = ['signResponse']
+    _response_field = 'signResponse'
+    _response_class = _CachedSignResponse
 
-    @property
+    @cached_property
     def signResponse(self):
-        return SignResponse.wrap(self['signResponse'])
-
-    @classmethod
-    def wrap(cls, data):
-        try:
-            return super(SignResponseData, cls).wrap(data)
-        except ValueError:
-            response = SignResponse.wrap(data)
-            return cls(signResponse=response.json)
+        return self._get_response()
@@ -0,0 +1,71 @@
+"""
+Pluggable JSON encoding and decoding.
+
+The backend is selected by the JSON_BACKEND setting, and may be 'orjson',
+'ujson', 'json' (the standard library), or 'auto' for the fastest of these
+which is installed. All backends produce compact output, and dumps() always
+returns text.
+"""
+
+from __future__ import absolute_import
+
+from . import app
+import json
+
+BACKENDS = ['orjson', 'ujson', 'json']
+
+
+def _orjson():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf8')
+    return dumps, orjson.loads
+
+
+def _ujson():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False,
+                           escape_forward_slashes=False)
+    return dumps, ujson.loads
+
+
+def _json():
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(data):
+        if isinstance(data, bytes):
+            data = data.decode('utf8')
+        return json.loads(data)
+    return dumps, loads
+
+
+_factories = {'orjson': _orjson, 'ujson': _ujson, 'json': _json}
+
+
+def load_backend(name):
+    """Returns (name, dumps, loads) for a backend."""
+    if name == 'auto':
+        for name in BACKENDS:
+            try:
+                return (name,) + _factories[name]()
+            except ImportError:
+                pass
+    if name not in _factories:
+        raise ValueError('Unknown JSON backend: %s' % name)
+    return (name,) + _factories[name]()
+
+
+def set_backend(name):
+    global backend, dumps, loads
+    backend, dumps, loads = load_backend(name)
+
+
+def dumps_pretty(obj):
+    return json.dumps(obj, indent=2, sort_keys=True, separators=(',', ': '))
+
+
+set_backend(app.config.get('JSON_BACKEND', 'auto'))
@@ -0,0 +1,247 @@
+from __future__ import absolute_import
+
+from . import app
+from .timing import get_timings, get_sql_stats, record_cache as _count_cache
+from flask import g, request
+from timeit import default_timer as timer
+from binascii import b2a_hex
+import threading
+import json
+import time
+import os
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+class Metrics(object):
+    """Counters and histograms, in the style of Prometheus.
+
+    Values are kept in memory per process, guarded by a single lock which is
+    only held while updating a dict entry. When a directory is given each
+    process periodically writes its values to its own file in it, and
+    collect() sums up the files of all processes. This allows a pre-fork
+    server to report metrics for all of its workers from any one of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._pid = None
+        self._token = None
+        self._last_flush = 0
+
+    def _check_fork(self):
+        # Values inherited from a parent process belong to the parent.
+        pid = os.getpid()
+        if pid != self._pid:
+            with self._lock:
+                if pid != self._pid:
+                    self._pid = pid
+                    self._token = b2a_hex(os.urandom(4)).decode('ascii')
+                    self._counters = {}
+                    self._histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        self._check_fork()
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        self._check_fork()
+        key = (name, tuple(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = \
+                    [list(buckets), [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(hist[0]):
+                if value <= bound:
+                    hist[1][i] += 1
+                    break
+            hist[2] += value
+            hist[3] += 1
+
+    def snapshot(self):
+        self._check_fork()
+        with self._lock:
+            return {
+                'counters': [[k[0], k[1], v]
+                             for k, v in self._counters.items()],
+                'histograms': [[k[0], k[1]] + [list(h[0]), list(h[1]), h[2],
+                                               h[3]]
+                               for k, h in self._histograms.items()]
+            }
+
+    def _path(self, directory):
+        return os.path.join(directory, 'metrics-%d-%s.json' % (
+            self._pid, self._token))
+
+    def flush(self, directory, interval=0):
+        """Writes the values of this process to a file in directory.
+
+        Does nothing if the last flush was less than interval seconds ago.
+        """
+        now = time.time()
+        if now - self._last_flush < interval:
+            return
+        self._last_flush = now
+        snapshot = self.snapshot()
+        path = self._path(directory)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(tmp, path)
+
+    def collect(self, directory=None):
+        """Returns the values of all processes, as (counters, histograms).
+
+        Counters map (name, labels) to a value, histograms map (name, labels)
+        to (buckets, counts, sum, count).
+        """
+        if directory is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush(directory)
+            snapshots = []
+            for fname in os.listdir(directory):
+                if fname.startswith('metrics-') and fname.endswith('.json'):
+                    try:
+                        with open(os.path.join(directory, fname)) as f:
+                            snapshots.append(json.load(f))
+                    except (IOError, ValueError):
+                        pass  # Removed, or being written.
+
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(x) for x in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, counts, total, count in \
+                    snapshot['histograms']:
+                key = (name, tuple(tuple(x) for x in labels))
+                hist = histograms.get(key)
+                if hist is None:
+                    histograms[key] = [buckets, counts, total, count]
+                else:
+                    hist[1] = [a + b for a, b in zip(hist[1], counts)]
+                    hist[2] += total
+                    hist[3] += count
+        return counters, histograms
+
+    def render(self, directory=None, gauges=None):
+        """Returns all metrics in the Prometheus text exposition format."""
+        counters, histograms = self.collect(directory)
+        lines = []
+        for name in sorted(set(k[0] for k in counters)):
+            lines.append('# TYPE %s counter' % name)
+            for key in sorted(k for k in counters if k[0] == name):
+                lines.append('%s%s %s' % (name, _format_labels(key[1]),
+                                          counters[key]))
+        for name in sorted(set(k[0] for k in histograms)):
+            lines.append('# TYPE %s histogram' % name)
+            for key in sorted(k for k in histograms if k[0] == name):
+                buckets, counts, total, count = histograms[key]
+                cumulative = 0
+                for bound, n in zip(buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(
+                        key[1], [('le', repr(float(bound)))]), cumulative))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(
+                    key[1], [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %s' % (name, _format_labels(key[1]),
+                                              repr(total)))
+                lines.append('%s_count%s %d' % (name, _format_labels(key[1]),
+                                                count))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def enabled():
+    return app.config.get('METRICS_PATH') is not None
+
+
+def is_metrics_request(environ):
+    """Checks if a WSGI request is for the metrics endpoint."""
+    return enabled() and environ.get('PATH_INFO') == app.config['METRICS_PATH']
+
+
+def record_error(code):
+    if enabled():
+        metrics.inc('u2fval_errors_total', [('code', code)])
+
+
+def record_cache(cache, hit):
+    _count_cache(hit)
+    if enabled():
+        metrics.inc('u2fval_cache_requests_total', [
+            ('cache', cache), ('result', 'hit' if hit else 'miss')])
+
+
+_gauges = {}
+
+
+def gauge(name):
+    """Registers a function to be called for the value of a gauge."""
+    def inner(func):
+        _gauges[name] = func
+        return func
+    return inner
+
+
+@app.before_request
+def _start_timer():
+    if not enabled():
+        return
+    if request.path == app.config['METRICS_PATH']:
+        gauges = dict((name, func()) for name, func in _gauges.items())
+        return app.response_class(
+            metrics.render(app.config.get('METRICS_DIR'), gauges),
+            mimetype='text/plain; version=0.0.4')
+    g.metrics_start = timer()
+
+
+@app.after_request
+def _record_request(response):
+    start = getattr(g, 'metrics_start', None)
+    if start is None:
+        return response
+    route = request.url_rule.endpoint if request.url_rule else 'unknown'
+    client = getattr(g, 'client', None)
+    labels = [('route', route),
+              ('client', client.name if client is not None else '')]
+    metrics.inc('u2fval_requests_total',
+                labels + [('status', response.status_code)])
+    metrics.observe('u2fval_request_duration_seconds', labels,
+                    timer() - start)
+    for name, seconds in get_timings().items():
+        metrics.observe('u2fval_phase_duration_seconds',
+                        [('route', route), ('phase', name)], seconds)
+    statements, seconds = get_sql_stats()
+    metrics.inc('u2fval_sql_statements_total', [('route', route)], statements)
+    metrics.inc('u2fval_sql_duration_seconds_total', [('route', route)],
+                seconds)
+    directory = app.config.get('METRICS_DIR')
+    if directory is not None:
+        metrics.flush(directory, app.config.get('METRICS_FLUSH_INTERVAL', 5))
+    return response
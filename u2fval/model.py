@@ -1,8 +1,11 @@
 from __future__ import absolute_import
 
-from . import app
+from . import app, jsonbackend
 from u2flib_server.model import Transport
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -13,13 +16,28 @@ from cryptography.hazmat.primitives.serialization import Encoding
 from base64 import b64encode, b64decode
 from binascii import b2a_hex
 from datetime import datetime
+import itertools
 import json
 import os
+import sqlite3
 
 
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys (and thus ON DELETE CASCADE) by default.
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def _random_version():
+    return int(b2a_hex(os.urandom(4)), 16) >> 2
+
+
 class Client(db.Model):
     __tablename__ = 'clients'
 
@@ -27,6 +45,9 @@ class Client(db.Model):
     name = db.Column(db.String(40), nullable=False, unique=True)
     app_id = db.Column(db.String(256), nullable=False)
     _valid_facets = db.Column('valid_facets', db.Text(), default='[]')
+    # Incremented whenever the client changes, like User.version.
+    version = db.Column(db.Integer, nullable=False, default=_random_version,
+                        server_default='0')
 
     def __init__(self, name, app_id, facets):
         self.name = name
@@ -35,7 +56,7 @@ class Client(db.Model):
 
     @hybrid_property
     def valid_facets(self):
-        return json.loads(self._valid_facets)
+        return jsonbackend.loads(self._valid_facets)
 
     @valid_facets.setter
     def valid_facets(self, facets):
@@ -55,22 +76,31 @@ class User(db.Model):
 
     id = db.Column(db.Integer, db.Sequence('user_id_seq'), primary_key=True)
     name = db.Column(db.String(40), nullable=False)
-    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'))
+    client_id = db.Column(db.Integer,
+                          db.ForeignKey('clients.id', ondelete='CASCADE'))
+    # Incremented whenever a device of the user changes, see bump_versions.
+    # Starts at a random value, so that (id, version) doesn't repeat if a
+    # deleted user's id is reused.
+    version = db.Column(db.Integer, nullable=False, default=_random_version,
+                        server_default='0')
     client = db.relationship(Client,
-                             backref=db.backref('users', lazy='dynamic'))
+                             backref=db.backref('users', lazy='dynamic',
+                                                passive_deletes=True))
     devices = db.relationship(
         'Device',
         backref='user',
         order_by='Device.handle',
         collection_class=attribute_mapped_collection('handle'),
-        cascade='all, delete-orphan'
+        cascade='all, delete-orphan',
+        passive_deletes=True
     )
     transactions = db.relationship(
         'Transaction',
         backref='user',
         order_by='Transaction.created_at.desc()',
         lazy='dynamic',
-        cascade='all, delete-orphan')
+        cascade='all, delete-orphan',
+        passive_deletes=True)
 
     def __init__(self, name):
         self.name = name
@@ -117,7 +147,8 @@ class Device(db.Model):
 
     id = db.Column(db.Integer, db.Sequence('device_id_seq'), primary_key=True)
     handle = db.Column(db.String(32), nullable=False, unique=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete='CASCADE'))
     bind_data = db.Column(db.Text())
     certificate_id = db.Column(db.Integer, db.ForeignKey('certificates.id'))
     certificate = db.relationship('Certificate')
@@ -131,7 +162,8 @@ class Device(db.Model):
         backref='device',
         order_by='Property.key',
         collection_class=attribute_mapped_collection('key'),
-        cascade='all, delete-orphan'
+        cascade='all, delete-orphan',
+        passive_deletes=True
     )
     properties = association_proxy(
         '_properties',
@@ -146,32 +178,113 @@ class Device(db.Model):
         self.certificate = certificate
         self.transports = transports
 
-    def update_properties(self, props):
-        for k, v in props.items():
-            if v is None:
-                del self.properties[k]
-            else:
-                self.properties[k] = v
+    def update_properties(self, *props):
+        """Sets properties, deleting those with a value of None.
+
+        Multiple dicts may be given, later ones taking precedence. The
+        changes are written at once, using a constant number of statements.
+        """
+        merged = {}
+        for p in props:
+            merged.update(p)
+        if not merged:
+            return
+        db.session.flush()  # Assigns an id to a new device.
+        properties = Property.__table__
+        db.session.execute(properties.delete().where(db.and_(
+            properties.c.device_id == self.id,
+            properties.c.key.in_(list(merged)))))
+        rows = [{'device_id': self.id, 'key': k, 'value': v}
+                for k, v in merged.items() if v is not None]
+        if rows:
+            db.session.execute(properties.insert(), rows)
+        bump_versions([self.user_id])
+        db.session.expire(self, ['_properties'])
+        db.session.expire(self.user, ['version'])
 
     def get_descriptor(self, metadata=None):
-        authenticated = self.authenticated_at
-        if authenticated is not None:
-            authenticated = authenticated.isoformat() + 'Z'
+        return _get_descriptor(self, self.properties, metadata)
+
+
+def _get_descriptor(dev, properties, metadata):
+    authenticated = dev.authenticated_at
+    if authenticated is not None:
+        authenticated = authenticated.isoformat() + 'Z'
+
+    transports = [t.key for t in Transport if t.value & dev.transports]
+    data = {
+        'handle': dev.handle,
+        'transports': transports,
+        'compromised': dev.compromised,
+        'created': dev.created_at.isoformat() + 'Z',
+        'lastUsed': authenticated,
+        'properties': dict(properties)
+    }
 
-        transports = [t.key for t in Transport if t.value & self.transports]
-        data = {
-            'handle': self.handle,
-            'transports': transports,
-            'compromised': self.compromised,
-            'created': self.created_at.isoformat() + 'Z',
-            'lastUsed': authenticated,
-            'properties': dict(self.properties)
-        }
+    if metadata is not None:
+        data['metadata'] = metadata
 
-        if metadata is not None:
-            data['metadata'] = metadata
+    return data
 
-        return data
+
+class DeviceRecord(object):
+    """A read-only Device, with its properties as a dict.
+
+    Loaded using load_device_records(), without the overhead of the ORM.
+    """
+    __slots__ = ('id', 'handle', 'bind_data', 'certificate_id',
+                 'compromised', 'created_at', 'authenticated_at',
+                 'transports', 'properties')
+
+    def __init__(self, row, properties):
+        for name in self.__slots__[:-1]:
+            setattr(self, name, row[name])
+        self.properties = properties
+
+    def get_descriptor(self, metadata=None):
+        return _get_descriptor(self, self.properties, metadata)
+
+
+def load_device_records(user_id):
+    """Returns the devices of a user as DeviceRecords, ordered by handle."""
+    return load_users_device_records([user_id])[user_id]
+
+
+def load_users_device_records(user_ids):
+    """Returns the devices of multiple users, as a dict of user id -> list of
+    DeviceRecords ordered by handle. Uses two queries regardless of the
+    number of users.
+    """
+    result = dict((user_id, []) for user_id in user_ids)
+    if not result:
+        return result
+    devices = Device.__table__
+    rows = db.session.execute(
+        db.select([devices.c[name] for name in DeviceRecord.__slots__[:-1]] +
+                  [devices.c.user_id])
+        .where(devices.c.user_id.in_(list(result)))
+        .order_by(devices.c.handle)
+    ).fetchall()
+    if not rows:
+        return result
+
+    properties = Property.__table__
+    by_device = {}
+    for device_id, key, value in db.session.execute(
+            db.select([properties.c.device_id, properties.c.key,
+                       properties.c.value])
+            .where(properties.c.device_id.in_([row.id for row in rows]))):
+        by_device.setdefault(device_id, {})[key] = value
+    for row in rows:
+        result[row.user_id].append(
+            DeviceRecord(row, by_device.get(row.id, {})))
+    return result
+
+
+def get_certificate_der(certificate_id):
+    der = db.session.query(Certificate._der) \
+        .filter(Certificate.id == certificate_id).scalar()
+    return b64decode(der)
 
 
 class Property(db.Model):
@@ -181,7 +294,8 @@ class Property(db.Model):
                    primary_key=True)
     key = db.Column(db.String(40))
     value = db.Column(db.Text())
-    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'))
+    device_id = db.Column(db.Integer,
+                          db.ForeignKey('devices.id', ondelete='CASCADE'))
 
     def __init__(self, key, value):
         self.key = key
@@ -193,7 +307,8 @@ class Transaction(db.Model):
 
     id = db.Column(db.Integer, db.Sequence('transaction_id_seq'),
                    primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete='CASCADE'))
     transaction_id = db.Column(db.String(64), nullable=False, unique=True)
     _data = db.Column(db.Text())
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -209,3 +324,55 @@ class Transaction(db.Model):
     @data.setter
     def data(self, value):
         self._data = json.dumps(value)
+
+
+def bump_versions(user_ids):
+    """Increments the version of users, for changes made to their devices
+    without using the ORM. The argument may be a list or a subquery.
+    """
+    User.query.filter(User.id.in_(user_ids)) \
+        .update({User.version: User.version + 1}, synchronize_session=False)
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_versions(session, flush_context, instances):
+    users = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Property):
+            obj = obj.device
+        if isinstance(obj, Device) and obj.user is not None and \
+                session.is_modified(obj):
+            users.add(obj.user)
+    for user in users:
+        if user not in session.new:
+            user.version = User.version + 1
+    for obj in session.dirty:
+        if isinstance(obj, Client) and \
+                session.is_modified(obj, include_collections=False):
+            obj.version = Client.version + 1
+
+
+def upgrade_schema():
+    """Creates missing tables, and adds missing columns to existing ones.
+
+    Returns the names of the added columns.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name,
+                column.type.compile(dialect=db.engine.dialect))
+            if column.server_default is not None:
+                ddl += ' DEFAULT %s' % column.server_default.arg
+            if not column.nullable:
+                ddl += ' NOT NULL'
+            db.session.execute(ddl)
+            added.append('%s.%s' % (table.name, column.name))
+    db.session.commit()
+    return added
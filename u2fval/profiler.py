@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+
+from . import app
+import threading
+import hmac
+import six
+import cProfile
+import pstats
+import random
+import time
+import os
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+PROFILE_HEADER = 'HTTP_X_U2FVAL_PROFILE'
+
+
+def _to_bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf8')
+    return value
+
+
+class ProfilerMiddleware(object):
+    """WSGI middleware profiling a sample of requests with cProfile.
+
+    Requests are profiled at random with a probability of PROFILE_SAMPLE_RATE,
+    and always when they carry an X-U2fval-Profile header matching
+    PROFILE_TOKEN. The statistics of all profiled requests are aggregated,
+    and written to a pstats file in PROFILE_DIR at most every
+    PROFILE_FLUSH_INTERVAL seconds. If PROFILE_TRACEMALLOC is set, a
+    tracemalloc snapshot is written alongside it.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._lock = threading.Lock()
+        self._stats = None
+        self._requests = 0
+        self._last_flush = time.time()
+
+    def _should_profile(self, environ):
+        token = app.config.get('PROFILE_TOKEN')
+        header = environ.get(PROFILE_HEADER)
+        if token and header is not None and \
+                hmac.compare_digest(_to_bytes(header), _to_bytes(token)):
+            return True
+        rate = app.config.get('PROFILE_SAMPLE_RATE') or 0
+        return rate > 0 and random.random() < rate
+
+    def _add(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._requests += 1
+
+    def flush(self, directory, interval=0):
+        """Writes the collected statistics to directory, and resets them.
+
+        Does nothing if the last flush was less than interval seconds ago.
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._last_flush < interval or self._stats is None:
+                return
+            stats, self._stats = self._stats, None
+            requests, self._requests = self._requests, 0
+            self._last_flush = now
+        name = '%d-%d-%d' % (os.getpid(), now * 1000, requests)
+        stats.dump_stats(os.path.join(directory, 'profile-%s.pstats' % name))
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(os.path.join(
+                directory, 'tracemalloc-%s.snapshot' % name))
+
+    def __call__(self, environ, start_response):
+        directory = app.config.get('PROFILE_DIR')
+        if not directory or not self._should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+
+        if app.config.get('PROFILE_TRACEMALLOC') and tracemalloc is not None \
+                and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Another request is being profiled.
+            return self.wsgi_app(environ, start_response)
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            profile.disable()
+            self._add(profile)
+            self.flush(directory, app.config.get('PROFILE_FLUSH_INTERVAL', 60))
+
+
+app.wsgi_app = profiler = ProfilerMiddleware(app.wsgi_app)
@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+
+from . import app, exc
+from .cache import cache
+from .metrics import enabled as metrics_enabled, metrics
+from flask import request
+from timeit import default_timer as timer
+from hashlib import sha256
+from collections import OrderedDict
+import threading
+import math
+import time
+
+
+class LocalBuckets(object):
+    """Token buckets kept in process memory.
+
+    Each bucket holds up to burst tokens, and is refilled at rate tokens per
+    second. At most max_size buckets are kept, the least recently used ones
+    being forgotten, so that memory use is bounded and each call takes
+    constant time even when flooded with distinct keys.
+    """
+
+    def __init__(self, max_size=10000, clock=timer):
+        self.max_size = max_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        """Takes a token from a bucket.
+
+        Returns 0 on success, or the number of seconds until a token will be
+        available.
+        """
+        now = self._clock()
+        with self._lock:
+            # Re-inserted below, to keep the buckets in order of use.
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                while len(self._buckets) >= self.max_size:
+                    self._buckets.popitem(last=False)
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now, rate, burst)
+                return 0
+            self._buckets[key] = (tokens, now, rate, burst)
+            return (1 - tokens) / rate
+
+
+class CacheBuckets(object):
+    """Rate limits shared between processes, using a (memcached) cache.
+
+    As memcached has no atomic compare-and-set suitable for a token bucket,
+    this approximates one with a counter per time window of burst / rate
+    seconds, allowing at most burst requests per window. The average rate is
+    the same, but up to twice the burst may be allowed at window boundaries.
+    If the cache is unavailable, requests are allowed.
+    """
+
+    def __init__(self, cache, clock=time.time):
+        self.cache = cache
+        self._clock = clock
+
+    def take(self, key, rate, burst):
+        window = burst / float(rate)
+        now = self._clock()
+        index = int(now / window)
+        cache_key = 'ratelimit/%s/%d' % (
+            sha256(key.encode('utf8')).hexdigest(), index)
+        self.cache.add(cache_key, 0, timeout=int(math.ceil(window)) + 1)
+        count = self.cache.inc(cache_key)
+        if count is None or count <= burst:
+            return 0
+        return (index + 1) * window - now
+
+
+_local = LocalBuckets()
+_shared = CacheBuckets(cache)
+
+
+def get_buckets():
+    if app.config.get('RATE_LIMIT_STORAGE') == 'memcached':
+        return _shared
+    return _local
+
+
+def get_limits(client):
+    """Returns the (rate, burst) limits for a client and for each of its
+    users, either of which may be None for no limit.
+    """
+    limits = (app.config.get('RATE_LIMITS') or {}).get(client, {})
+    return (limits.get('client', app.config.get('RATE_LIMIT_CLIENT')),
+            limits.get('user', app.config.get('RATE_LIMIT_USER')))
+
+
+def client_name():
+    """Returns the name of the client making the request, without looking it
+    up in the database. Like get_client, this only trusts the username of
+    Basic authentication in debug mode.
+    """
+    name = request.environ.get('REMOTE_USER')
+    if name is None and app.debug and request.authorization:
+        name = request.authorization.username
+    return name
+
+
+def _check(scope, key, limit):
+    wait = get_buckets().take(key, *limit)
+    if wait > 0:
+        if metrics_enabled():
+            metrics.inc('u2fval_rate_limited_requests_total',
+                        [('scope', scope)])
+        raise exc.TooManyRequestsException(
+            'Rate limit exceeded', int(math.ceil(wait)))
+
+
+def check_user(user_id):
+    """Takes a token from the bucket of a user of the requesting client.
+
+    Raises TooManyRequestsException if the user is over its limit. Called
+    for each request to a user, and for each operation of a batch request.
+    """
+    client = client_name()
+    if client is None:
+        return
+    user_limit = get_limits(client)[1]
+    if user_limit is not None:
+        _check('user', '%s/%s' % (client, user_id), user_limit)
+
+
+@app.before_request
+def _limit():
+    client = client_name()
+    if client is None:
+        return
+    client_limit = get_limits(client)[0]
+    if client_limit is not None:
+        _check('client', client, client_limit)
+    user_id = (request.view_args or {}).get('user_id')
+    if user_id is not None:
+        check_user(user_id)
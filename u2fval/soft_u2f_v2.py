@@ -66,7 +66,7 @@ class SoftU2FDevice(object):
 
     """
     This simulates the U2F browser API with a soft U2F device connected.
-    It can be used for testing.
+    It can be used for testing and benchmarking.
     """
     def __init__(self):
         self.keys = {}
@@ -112,9 +112,7 @@ class SoftU2FDevice(object):
             CERT_PRIV, password=None, backend=default_backend())
         cert = CERT
         data = b'\x00' + app_param + client_param + key_handle + pub_key
-        signer = cert_priv.signer(ec.ECDSA(hashes.SHA256()))
-        signer.update(data)
-        signature = signer.finalize()
+        signature = cert_priv.sign(data, ec.ECDSA(hashes.SHA256()))
 
         raw_response = (b'\x05' + pub_key + six.int2byte(len(key_handle)) +
                         key_handle + cert + signature)
@@ -163,9 +161,7 @@ class SoftU2FDevice(object):
         counter = struct.pack('>I', self.counter)
 
         data = app_param + touch + counter + client_param
-        signer = priv_key.signer(ec.ECDSA(hashes.SHA256()))
-        signer.update(data)
-        signature = signer.finalize()
+        signature = priv_key.sign(data, ec.ECDSA(hashes.SHA256()))
         raw_response = touch + counter + signature
 
         return SignResponse(
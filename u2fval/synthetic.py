@@ -0,0 +1,176 @@
+from __future__ import absolute_import
+
+from .model import (db, Client, User, Certificate, Device, Property,
+                    Transaction, _calculate_fingerprint)
+from .soft_u2f_v2 import CERT
+from u2flib_server.utils import websafe_encode
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import (Encoding,
+                                                          PublicFormat)
+from base64 import b64encode
+from binascii import a2b_hex
+from datetime import datetime, timedelta
+import random
+import json
+
+# The order of the NIST P-256 curve.
+_P256_ORDER = int('ffffffff00000000ffffffffffffffff'
+                  'bce6faada7179e84f3b9cac2fc632551', 16)
+
+# Fixed reference time, so that the output only depends on the seed.
+_EPOCH = datetime(2017, 1, 1)
+
+_PROPERTY_KEYS = ['name', 'description', 'registeredBy', 'lastIp', 'model']
+
+
+class Generator(object):
+    """Generates realistic synthetic data for scale testing.
+
+    All rows are inserted with batched INSERT statements, bypassing the ORM
+    and the register flow. Devices get well-formed bind_data with valid
+    public keys (drawn from a small pool of keys, for speed) and unique key
+    handles, and all share the soft U2F attestation certificate. Given the
+    same seed and arguments the generated data is identical, except for
+    database ids and the creation time of transactions, which are always
+    recent so that they are still valid.
+    """
+
+    def __init__(self, seed=0, devices_per_user=2, properties_per_device=2,
+                 transaction_ratio=0.01, batch_size=5000, n_keys=16):
+        self._rand = random.Random(seed)
+        self.devices_per_user = devices_per_user
+        self.properties_per_device = min(properties_per_device,
+                                         len(_PROPERTY_KEYS))
+        self.transaction_ratio = transaction_ratio
+        self.batch_size = batch_size
+        self._public_keys = [self._public_key() for _ in range(n_keys)]
+
+    def _bytes(self, n):
+        return a2b_hex('%0*x' % (2 * n, self._rand.getrandbits(8 * n)))
+
+    def _public_key(self):
+        value = self._rand.randrange(1, _P256_ORDER)
+        priv_key = ec.derive_private_key(value, ec.SECP256R1(),
+                                         default_backend())
+        pub_key = priv_key.public_key().public_bytes(
+            Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+        return websafe_encode(pub_key[-65:])
+
+    def _certificate_id(self):
+        cert = x509.load_der_x509_certificate(CERT, default_backend())
+        fingerprint = _calculate_fingerprint(cert)
+        cert_id = db.session.query(Certificate.id) \
+            .filter(Certificate.fingerprint == fingerprint).scalar()
+        if cert_id is None:
+            db.session.execute(Certificate.__table__.insert(), {
+                'fingerprint': fingerprint,
+                'der': b64encode(CERT).decode('ascii')
+            })
+            cert_id = db.session.query(Certificate.id) \
+                .filter(Certificate.fingerprint == fingerprint).scalar()
+        return cert_id
+
+    def _timestamp(self, days):
+        return _EPOCH - timedelta(seconds=self._rand.randrange(days * 86400))
+
+    def _device(self, user_id, app_id, cert_id):
+        created = self._timestamp(3 * 365)
+        authenticated = None
+        if self._rand.random() < 0.8:
+            authenticated = created + timedelta(
+                seconds=self._rand.randrange(int(
+                    (_EPOCH - created).total_seconds()) + 1))
+        return {
+            'handle': '%032x' % self._rand.getrandbits(128),
+            'user_id': user_id,
+            'bind_data': json.dumps({
+                'version': 'U2F_V2',
+                'keyHandle': websafe_encode(self._bytes(64)),
+                'appId': app_id,
+                'publicKey': self._rand.choice(self._public_keys),
+                'transports': None
+            }),
+            'certificate_id': cert_id,
+            'compromised': self._rand.random() < 0.001,
+            'created_at': created,
+            'authenticated_at': authenticated,
+            'counter': self._rand.randrange(1000) if authenticated else None,
+            'transports': 0
+        }
+
+    def _transaction(self, user_id, app_id):
+        challenge = websafe_encode(self._bytes(32))
+        return {
+            'user_id': user_id,
+            'transaction_id': '%064x' % self._rand.getrandbits(256),
+            '_data': json.dumps({
+                'appId': app_id,
+                'challenge': challenge,
+                'properties': {}
+            }),
+            'created_at': datetime.utcnow()
+        }
+
+    def _max_id(self, column):
+        return db.session.query(db.func.max(column)).scalar() or 0
+
+    def _insert_users(self, client_id, app_id, names, cert_id):
+        last_user = self._max_id(User.id)
+        last_device = self._max_id(Device.id)
+        db.session.execute(User.__table__.insert(), [
+            {'client_id': client_id, 'name': name} for name in names])
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)
+                    .filter(User.client_id == client_id)
+                    .filter(User.id > last_user).order_by(User.id)]
+
+        devices = [self._device(user_id, app_id, cert_id)
+                   for user_id in user_ids
+                   for _ in range(self.devices_per_user)]
+        if devices:
+            db.session.execute(Device.__table__.insert(), devices)
+        device_ids = [device_id for (device_id,) in db.session.query(Device.id)
+                      .filter(Device.id > last_device).order_by(Device.id)]
+
+        properties = []
+        for device_id in device_ids:
+            for key in self._rand.sample(_PROPERTY_KEYS,
+                                         self.properties_per_device):
+                properties.append({
+                    'device_id': device_id,
+                    'key': key,
+                    'value': websafe_encode(self._bytes(12))
+                })
+        if properties:
+            db.session.execute(Property.__table__.insert(), properties)
+
+        transactions = [self._transaction(user_id, app_id)
+                        for user_id in user_ids
+                        if self._rand.random() < self.transaction_ratio]
+        if transactions:
+            db.session.execute(Transaction.__table__.insert(), transactions)
+        return len(devices)
+
+    def generate(self, n_clients, users_per_client, prefix='synthetic'):
+        """Creates clients with users and devices, committing per batch.
+
+        Yields the total number of devices created after each batch.
+        """
+        cert_id = self._certificate_id()
+        created = 0
+        for i in range(n_clients):
+            name = '%s-%d' % (prefix, i)
+            app_id = 'https://%s.example.com' % name
+            db.session.add(Client(name, app_id, [app_id]))
+            db.session.flush()
+            client_id = db.session.query(Client.id) \
+                .filter(Client.name == name).scalar()
+            for offset in range(0, users_per_client, self.batch_size):
+                names = ['user%d' % j for j in range(
+                    offset, min(offset + self.batch_size, users_per_client))]
+                created += self._insert_users(client_id, app_id, names,
+                                              cert_id)
+                db.session.commit()
+                yield created
+            db.session.commit()
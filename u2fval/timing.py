@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+
+from . import app
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from timeit import default_timer as timer
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import json
+
+slow_log = logging.getLogger('u2fval.slow')
+slow_log.propagate = False
+
+
+@contextmanager
+def phase(name):
+    """Measures the time spent in a phase of handling the current request.
+
+    Time spent in multiple occurrences of the same phase is added up. Nested
+    occurrences of a phase are only counted once.
+    """
+    if not has_app_context():
+        yield
+        return
+    active = g.setdefault('phases_active', set())
+    if name in active:
+        yield
+        return
+    active.add(name)
+    start = timer()
+    try:
+        yield
+    finally:
+        active.discard(name)
+        timings = g.setdefault('phase_timings', {})
+        timings[name] = timings.get(name, 0) + timer() - start
+
+
+def get_timings():
+    """Returns a dict of phase name -> seconds, for the current request."""
+    return getattr(g, 'phase_timings', {})
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    # Kept on the context, which is discarded even if the statement fails.
+    if context is not None:
+        context._u2fval_start = timer()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_u2fval_start', None)
+    if start is None:
+        return
+    elapsed = timer() - start
+    if has_app_context():
+        g.sql_statements = getattr(g, 'sql_statements', 0) + 1
+        g.sql_time = getattr(g, 'sql_time', 0) + elapsed
+
+
+def get_sql_stats():
+    """Returns (number of SQL statements, seconds spent executing them), for
+    the current request.
+    """
+    return getattr(g, 'sql_statements', 0), getattr(g, 'sql_time', 0)
+
+
+def record_cache(hit):
+    """Counts a cache lookup for the current request."""
+    if has_app_context():
+        key = 'cache_hits' if hit else 'cache_misses'
+        setattr(g, key, getattr(g, key, 0) + 1)
+
+
+def record_devices(n):
+    """Records the number of devices the current request operates on."""
+    if has_app_context():
+        g.device_count = n
+
+
+def _configure_slow_log():
+    if not slow_log.handlers:
+        path = app.config.get('SLOW_REQUEST_LOG')
+        if path:
+            handler = logging.FileHandler(path)
+        else:
+            handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        slow_log.addHandler(handler)
+        slow_log.setLevel(logging.INFO)
+
+
+@app.before_request
+def _start_request():
+    g.request_start = timer()
+
+
+@app.after_request
+def _add_server_timing(response):
+    if app.debug:
+        statements, seconds = get_sql_stats()
+        app.logger.debug('%s %s: %d SQL statements in %.1f ms',
+                         request.method, request.path, statements,
+                         seconds * 1000)
+    if app.config.get('SERVER_TIMING') or app.debug:
+        entries = ['%s;dur=%.3f' % (name, seconds * 1000)
+                   for name, seconds in sorted(get_timings().items())]
+        statements, seconds = get_sql_stats()
+        entries.append('sql;desc="%d statements";dur=%.3f' % (
+            statements, seconds * 1000))
+        start = getattr(g, 'request_start', None)
+        if start is not None:
+            entries.append('total;dur=%.3f' % ((timer() - start) * 1000))
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+@app.after_request
+def _log_slow_request(response):
+    threshold = app.config.get('SLOW_REQUEST_THRESHOLD')
+    start = getattr(g, 'request_start', None)
+    if threshold is None or start is None:
+        return response
+    duration = timer() - start
+    if duration < threshold:
+        return response
+
+    _configure_slow_log()
+    client = getattr(g, 'client', None)
+    statements, sql_time = get_sql_stats()
+    slow_log.info(json.dumps({
+        'time': datetime.utcnow().isoformat() + 'Z',
+        'method': request.method,
+        'path': request.path,
+        'route': request.url_rule.endpoint if request.url_rule else None,
+        'status': response.status_code,
+        'client': client.name if client is not None else None,
+        'user': (request.view_args or {}).get('user_id'),
+        'devices': getattr(g, 'device_count', None),
+        'duration_ms': round(duration * 1000, 3),
+        'sql_statements': statements,
+        'sql_ms': round(sql_time * 1000, 3),
+        'cache_hits': getattr(g, 'cache_hits', 0),
+        'cache_misses': getattr(g, 'cache_misses', 0),
+        'phases': dict((name, round(seconds * 1000, 3))
+                       for name, seconds in get_timings().items())
+    }, sort_keys=True))
+    return response
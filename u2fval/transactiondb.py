@@ -27,52 +27,110 @@
 
 from __future__ import absolute_import
 
+from . import jsonbackend
 from .model import db, User, Transaction
+from .cache import forget_missing_user
 from u2flib_server.utils import sha_256
+from sqlalchemy import bindparam, select
 from datetime import datetime, timedelta
 from binascii import b2a_hex
 
+_users = User.__table__
+_transactions = Transaction.__table__
+
+_SELECT_USER = select([_users.c.id]).where(
+    (_users.c.client_id == bindparam('client_id')) &
+    (_users.c.name == bindparam('name')))
+_INSERT_USER = _users.insert()
+_DELETE_EXPIRED = _transactions.delete().where(
+    _transactions.c.created_at < bindparam('expiration'))
+# The id of the newest transaction of a user which should be deleted, to keep
+# no more than max_transactions - 1 of them.
+_SELECT_CUTOFF = select([_transactions.c.id]) \
+    .where(_transactions.c.user_id == bindparam('user_id')) \
+    .order_by(_transactions.c.id.desc()) \
+    .limit(1).offset(bindparam('offset'))
+_DELETE_OLDEST = _transactions.delete().where(
+    (_transactions.c.user_id == bindparam('user_id')) &
+    (_transactions.c.id <= bindparam('cutoff')))
+_INSERT = _transactions.insert()
+_SELECT = select([_transactions.c.id, _transactions.c['_data'], _users.c.name,
+                  _users.c.client_id]) \
+    .select_from(_transactions.join(_users)) \
+    .where(_transactions.c.transaction_id == bindparam('transaction_id'))
+_DELETE = _transactions.delete().where(
+    _transactions.c.id == bindparam('id'))
+_DELETE_RETURNING = _transactions.delete().where(
+    (_transactions.c.transaction_id == bindparam('transaction_id')) &
+    _transactions.c.user_id.in_(_SELECT_USER)
+).returning(_transactions.c['_data'])
+
 
 class DBStore(object):
+    """Stores transactions in the database.
+
+    Uses prebuilt Core statements with a compiled statement cache, rather
+    than the ORM. On databases supporting DELETE ... RETURNING (PostgreSQL)
+    a transaction is retrieved and deleted in a single statement.
+    """
 
     def __init__(self, max_transactions=5, ttl=300):
         self._max_transactions = max_transactions
         self._ttl = ttl
+        self._compiled_cache = {}
 
-    def _delete_expired(self):
+    def _connection(self):
+        return db.session.connection().execution_options(
+            compiled_cache=self._compiled_cache)
+
+    def _delete_expired(self, conn):
         expiration = datetime.utcnow() - timedelta(seconds=self._ttl)
-        Transaction.query \
-            .filter(Transaction.created_at < expiration).delete()
+        conn.execute(_DELETE_EXPIRED, expiration=expiration)
 
     def store(self, client_id, user_id, transaction_id, data):
-        transaction_id = b2a_hex(sha_256(transaction_id))
-        user = User.query \
-            .filter(User.client_id == client_id) \
-            .filter(User.name == user_id).first()
-        if user is None:
-            user = User(user_id)
-            user.client_id = client_id
-            db.session.add(user)
+        transaction_id = b2a_hex(sha_256(transaction_id)).decode('ascii')
+        conn = self._connection()
+        user = conn.execute(_SELECT_USER, client_id=client_id,
+                            name=user_id).scalar()
+        created = user is None
+        if created:
+            user = conn.execute(_INSERT_USER, client_id=client_id,
+                                name=user_id).inserted_primary_key[0]
         else:
-            self._delete_expired()
+            self._delete_expired(conn)
             # Delete oldest transactions until we have room for one more.
-            for transaction in user.transactions \
-                    .offset(self._max_transactions - 1).all():
-                db.session.delete(transaction)
-        user.transactions.append(Transaction(transaction_id, data))
+            cutoff = conn.execute(_SELECT_CUTOFF, user_id=user,
+                                  offset=self._max_transactions - 1).scalar()
+            if cutoff is not None:
+                conn.execute(_DELETE_OLDEST, user_id=user, cutoff=cutoff)
+        conn.execute(_INSERT, user_id=user, transaction_id=transaction_id,
+                     _data=jsonbackend.dumps(data),
+                     created_at=datetime.utcnow())
         db.session.commit()
+        if created:
+            forget_missing_user(client_id, user_id)
+
+    def count(self):
+        return Transaction.query.count()
 
     def retrieve(self, client_id, user_id, transaction_id):
-        transaction_id = b2a_hex(sha_256(transaction_id))
-        self._delete_expired()
-        transaction = Transaction.query \
-            .filter(Transaction.transaction_id == transaction_id).first()
-        if transaction is None:
+        transaction_id = b2a_hex(sha_256(transaction_id)).decode('ascii')
+        conn = self._connection()
+        self._delete_expired(conn)
+        if conn.dialect.name == 'postgresql':
+            data = conn.execute(_DELETE_RETURNING,
+                                transaction_id=transaction_id,
+                                client_id=client_id, name=user_id).scalar()
+            if data is not None:
+                db.session.commit()
+                return jsonbackend.loads(data)
+
+        row = conn.execute(_SELECT, transaction_id=transaction_id).first()
+        if row is None:
             raise ValueError('Invalid transaction')
-        if transaction.user.name != user_id or \
-                transaction.user.client_id != client_id:
+        if row.name != user_id or row.client_id != client_id:
             raise ValueError('Transaction not valid for user_id: %s'
                              % user_id)
-        db.session.delete(transaction)
+        conn.execute(_DELETE, id=row.id)
         db.session.commit()
-        return transaction.data
+        return jsonbackend.loads(row['_data'])
@@ -1,10 +1,16 @@
 from __future__ import absolute_import
 
-from . import app, exc
-from .model import db, Client, User
+from . import app, exc, jsonbackend
+from .model import (db, Client, User, load_users_device_records,
+                    get_certificate_der)
 from .transactiondb import DBStore
-from flask import g, request, jsonify
-from werkzeug.contrib.cache import SimpleCache, MemcachedCache
+from .cache import (cache, is_missing_user, set_missing_user,
+                    forget_missing_user)
+from .bulk import delete_users, delete_devices
+from .metrics import gauge, record_cache, record_error
+from .timing import phase, record_devices
+from . import ratelimit, admission  # noqa
+from flask import g, request
 from u2flib_server.utils import websafe_decode
 from u2flib_server.u2f import (begin_registration, complete_registration,
                                begin_authentication, complete_authentication)
@@ -14,18 +20,13 @@ from .jsobjects import (RegisterRequestData, RegisterResponseData,
 from datetime import datetime
 from hashlib import sha256
 from six.moves.urllib.parse import unquote
-import json
+import six
 import os
 import re
 
 
-if app.config['USE_MEMCACHED']:
-    cache = MemcachedCache(app.config['MEMCACHED_SERVERS'])
-else:
-    cache = SimpleCache()
-
-
 store = DBStore()
+gauge('u2fval_transactions')(store.count)
 
 
 def create_metadata_provider(location):
@@ -40,28 +41,64 @@ def create_metadata_provider(location):
 metadata = create_metadata_provider(app.config.get('METADATA'))
 
 
+def jsonify(data):
+    with phase('json'):
+        if app.config['JSONIFY_PRETTYPRINT_REGULAR']:
+            body = jsonbackend.dumps_pretty(data)
+        else:
+            body = jsonbackend.dumps(data)
+        return app.response_class(body + '\n',
+                                  mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+def check_etag(etag):
+    """Returns a 304 Not Modified response if the request has an
+    If-None-Match header matching etag, otherwise None.
+    """
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+
+
+def get_json():
+    """Parses the body of the request as JSON."""
+    with phase('json'):
+        return jsonbackend.loads(request.get_data(cache=False))
+
+
+def _parse_properties(value):
+    return jsonbackend.loads(unquote(value))
+
+
 def get_attestation(cert):
-    key = sha256(cert).hexdigest()
-    attestation = cache.get(key)
-    if attestation is None:
-        attestation = metadata.get_attestation(cert) or ''  # Cache "missing"
-        cache.set(key, attestation, timeout=0)
-    return attestation
+    with phase('metadata'):
+        key = sha256(cert).hexdigest()
+        attestation = cache.get(key)
+        record_cache('attestation', attestation is not None)
+        if attestation is None:
+            # Cache "missing"
+            attestation = metadata.get_attestation(cert) or ''
+            cache.set(key, attestation, timeout=0)
+        return attestation
 
 
 def get_metadata(dev):
-    key = 'cert_metadata/%d' % dev.certificate_id
-    data = cache.get(key)
-    if data is None:
-        data = {}
-        attestation = get_attestation(dev.certificate.der)
-        if attestation:
-            if attestation.vendor_info:
-                data['vendor'] = attestation.vendor_info
-            if attestation.device_info:
-                data['device'] = attestation.device_info
-        cache.set(key, data, timeout=0)
-    return data
+    with phase('metadata'):
+        key = 'cert_metadata/%d' % dev.certificate_id
+        data = cache.get(key)
+        record_cache('metadata', data is not None)
+        if data is None:
+            data = {}
+            attestation = get_attestation(
+                get_certificate_der(dev.certificate_id))
+            if attestation:
+                if attestation.vendor_info:
+                    data['vendor'] = attestation.vendor_info
+                if attestation.device_info:
+                    data['device'] = attestation.device_info
+            cache.set(key, data, timeout=0)
+        return data
 
 
 def get_client():
@@ -73,14 +110,54 @@ def get_client():
         if name is None:
             raise exc.BadInputException('No client specified')
         try:
-            g.client = client = Client.query.filter(Client.name == name).one()
+            with phase('client'):
+                g.client = client = Client.query \
+                    .filter(Client.name == name).one()
         except:
             raise exc.NotFoundException('Client not found')
     return client
 
 
-def get_user(user_id):
-    return get_client().users.filter(User.name == user_id).first()
+def get_user(user_id, use_cache=True):
+    """Returns the user with the given name, or None if it doesn't exist.
+
+    Users which don't exist are remembered for MISSING_USER_CACHE_TTL
+    seconds. As this may be outdated when running multiple processes without
+    memcached, use_cache=False should be given when a stale answer would
+    cause an error.
+    """
+    users = g.setdefault('users', {})
+    user = users.get(user_id)
+    if user is not None or (use_cache and user_id in users):
+        return user
+    client = get_client()
+    if use_cache and app.config.get('MISSING_USER_CACHE_TTL'):
+        missing = is_missing_user(client.id, user_id)
+        record_cache('missing_user', missing)
+        if missing:
+            return None
+    with phase('user'):
+        user = users[user_id] = \
+            client.users.filter(User.name == user_id).first()
+    if user is None:
+        set_missing_user(client.id, user_id)
+    return user
+
+
+def prefetch_users(user_ids):
+    """Loads multiple users using a single query, for use by get_user."""
+    client = get_client()
+    users = g.setdefault('users', {})
+    names = [name for name in set(user_ids) if name not in users]
+    if not names:
+        return
+    with phase('user'):
+        found = dict((user.name, user) for user in
+                     client.users.filter(User.name.in_(names)))
+    for name in names:
+        users[name] = found.get(name)
+        if users[name] is None:
+            set_missing_user(client.id, name)
 
 
 # Exception handling
@@ -88,6 +165,7 @@ def get_user(user_id):
 
 @app.errorhandler(400)
 def handle_bad_request(error):
+    record_error(exc.BadInputException.code)
     resp = jsonify({
         'errorCode': exc.BadInputException.code,
         'errorMessage': error.description
@@ -98,6 +176,7 @@ def handle_bad_request(error):
 
 @app.errorhandler(ValueError)
 def handle_value_error(error):
+    record_error(exc.BadInputException.code)
     resp = jsonify({
         'errorCode': exc.BadInputException.code,
         'errorMessage': str(error)
@@ -108,11 +187,15 @@ def handle_value_error(error):
 
 @app.errorhandler(exc.U2fException)
 def handle_http_exception(error):
+    record_error(error.code)
     resp = jsonify({
         'errorCode': error.code,
         'errorMessage': error.message
     })
     resp.status_code = error.status_code
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        resp.headers['Retry-After'] = str(retry_after)
     return resp
 
 
@@ -122,65 +205,173 @@ def handle_http_exception(error):
 @app.route('/')
 def trusted_facets():
     client = get_client()
-    return jsonify({
-        'trustedFacets': [{
-            'version': {'major': 1, 'minor': 0},
-            'ids': client.valid_facets
-        }]
-    })
+    etag = 'client-%d-%d' % (client.id, client.version)
+    resp = check_etag(etag)
+    if resp is None:
+        resp = jsonify({
+            'trustedFacets': [{
+                'version': {'major': 1, 'minor': 0},
+                'ids': client.valid_facets
+            }]
+        })
+        resp.set_etag(etag)
+    max_age = app.config.get('TRUSTED_FACETS_MAX_AGE')
+    if max_age is not None:
+        resp.cache_control.private = True
+        resp.cache_control.max_age = max_age
+    return resp
+
+
+def _user_etag(user):
+    # The version of the user changes whenever any of its devices does.
+    return 'user-%d-%d' % (user.id, user.version)
 
 
 @app.route('/<user_id>', methods=['GET', 'DELETE'], strict_slashes=False)
 def user(user_id):
-    user = get_user(user_id)
+    user = get_user(user_id, use_cache=request.method == 'GET')
     if request.method == 'DELETE':
         if user:
             app.logger.info('Delete user: "%s/%s"', user.client.name,
                             user.name)
-            db.session.delete(user)
+            delete_users([user.id])
             db.session.commit()
         return ('', 204)
+    elif user is None:
+        # No ETag, as the user may be known missing from a stale cache.
+        record_devices(0)
+        return jsonify([])
     else:
-        if user is not None:
-            descriptors = [d.get_descriptor(get_metadata(d))
-                           for d in user.devices.values()]
-        else:
-            descriptors = []
-        return jsonify(descriptors)
-
-
-def _get_registered_key(dev, descriptor):
-    key = json.loads(dev.bind_data)
-    # Only keep appId if different from the "main" one.
-    if key.get('appId') == get_client().app_id:
-        del key['appId']
+        etag = _user_etag(user)
+        resp = check_etag(etag)
+        if resp is not None:
+            return resp
+        descriptors = [k['descriptor'] for k in get_user_keys(user)]
+        record_devices(len(descriptors))
+        resp = jsonify(descriptors)
+        resp.set_etag(etag)
+        return resp
+
+
+def _load_bind_data(bind_data):
+    key = jsonbackend.loads(bind_data)
     # The 'version' field used to be missing in RegisteredKey.
     if 'version' not in key:
         key['version'] = 'U2F_V2'
+    return key
+
+
+def _get_registered_key(dev, descriptor):
+    key = _load_bind_data(dev.bind_data)
     # Use transports from descriptor (which includes metadata)
     key['transports'] = descriptor['transports']
 
     return key
 
 
+def _client_key(key):
+    # Only keep appId if different from the "main" one.
+    if key.get('appId') == get_client().app_id:
+        key = dict(key)
+        del key['appId']
+    return key
+
+
+def get_user_keys(user):
+    """Returns the registered keys and descriptors of the devices of a user.
+
+    The result is cached for USER_KEYS_CACHE_TTL seconds per version of the
+    user, which changes whenever any of its devices does.
+    """
+    prefetch_user_keys([user])
+    return g.user_keys[(user.id, user.version)]
+
+
+def prefetch_user_keys(users):
+    """Loads the keys of multiple users, for use by get_user_keys.
+
+    Cached keys are fetched at once, and the devices of the remaining users
+    are bulk loaded.
+    """
+    loaded = g.setdefault('user_keys', {})
+    versions = [(user.id, user.version) for user in users]
+    missing = [v for v in set(versions) if v not in loaded]
+    if not missing:
+        return
+    ttl = app.config.get('USER_KEYS_CACHE_TTL')
+    if ttl:
+        cached = cache.get_many(*['user_keys/%d/%d' % v for v in missing])
+        for version, keys in zip(list(missing), cached):
+            record_cache('user_keys', keys is not None)
+            if keys is not None:
+                loaded[version] = keys
+                missing.remove(version)
+        if not missing:
+            return
+
+    records = load_users_device_records([user_id for user_id, _ in missing])
+    for user_id, version in missing:
+        keys = []
+        for dev in records[user_id]:
+            descriptor = dev.get_descriptor(get_metadata(dev))
+            keys.append({
+                'handle': dev.handle,
+                'compromised': dev.compromised,
+                'key': _get_registered_key(dev, descriptor),
+                'descriptor': descriptor
+            })
+        loaded[(user_id, version)] = keys
+        if ttl:
+            cache.set('user_keys/%d/%d' % (user_id, version), keys,
+                      timeout=ttl)
+
+
+def _retrieve_transaction(user_id, challenge):
+    """Retrieves the stored state of a registration or authentication.
+
+    Only what is needed to complete it is stored: appId, challenge, the
+    properties to set, and for authentications a map of key handles to
+    device handles. The public keys are read from the devices on completion.
+    """
+    with phase('store'):
+        data = store.retrieve(get_client().id, user_id, challenge)
+    if data is None:
+        raise exc.NotFoundException('Transaction not found')
+    if isinstance(data, six.string_types):
+        # Stored by an older version, as the complete request.
+        data = jsonbackend.loads(data)
+        return {
+            'appId': data['appId'],
+            'challenge': data.get('challenge') or
+            data['registerRequests'][0]['challenge'],
+            'handles': data.get('handleMap'),
+            'properties': data['properties']
+        }
+    return data
+
+
 def _register_request(user_id, challenge, properties):
     client = get_client()
     user = get_user(user_id)
     registered_keys = []
     descriptors = []
     if user is not None:
-        for dev in user.devices.values():
-            descriptor = dev.get_descriptor(get_metadata(dev))
-            descriptors.append(descriptor)
-            key = _get_registered_key(dev, descriptor)
-            registered_keys.append(key)
-    request_data = begin_registration(
-        client.app_id,
-        registered_keys,
-        challenge
-    )
-    request_data['properties'] = properties
-    store.store(client.id, user_id, challenge, request_data.json)
+        for k in get_user_keys(user):
+            descriptors.append(k['descriptor'])
+            registered_keys.append(_client_key(k['key']))
+    record_devices(len(descriptors))
+    with phase('crypto'):
+        request_data = begin_registration(
+            client.app_id,
+            registered_keys,
+            challenge
+        )
+    with phase('store'):
+        store.store(client.id, user_id, challenge, {
+            'appId': request_data['appId'],
+            'challenge': request_data['registerRequests'][0]['challenge'],
+            'properties': properties
+        })
 
     data = RegisterRequestData.wrap(request_data.data_for_client)
     data['descriptors'] = descriptors
@@ -189,28 +380,35 @@ def _register_request(user_id, challenge, properties):
 
 def _register_response(user_id, response_data):
     client = get_client()
-    user = get_user(user_id)
+    user = get_user(user_id, use_cache=False)
     register_response = response_data.registerResponse
     challenge = register_response.clientData.challenge
-    request_data = store.retrieve(client.id, user_id, challenge)
-    if request_data is None:
-        raise exc.NotFoundException('Transaction not found')
-    request_data = json.loads(request_data)
-    registration, cert = complete_registration(
-        request_data, register_response, client.valid_facets)
+    transaction = _retrieve_transaction(user_id, challenge)
+    request_data = {
+        'appId': transaction['appId'],
+        'registerRequests': [
+            {'version': 'U2F_V2', 'challenge': transaction['challenge']}],
+        'registeredKeys': []
+    }
+    with phase('crypto'):
+        registration, cert = complete_registration(
+            request_data, register_response, client.valid_facets)
     attestation = get_attestation(cert)
     if not app.config['ALLOW_UNTRUSTED'] and not attestation.trusted:
         raise exc.BadInputException('Device attestation not trusted')
-    if user is None:
+    created = user is None
+    if created:
         app.logger.info('Creating user: %s/%s', client.name, user_id)
         user = User(user_id)
         client.users.append(user)
     transports = sum(t.value for t in attestation.transports or [])
     dev = user.add_device(registration.json, cert, transports)
     # Properties from the initial request have a lower precedence.
-    dev.update_properties(request_data['properties'])
-    dev.update_properties(response_data.properties)
+    dev.update_properties(transaction['properties'],
+                          response_data.properties)
     db.session.commit()
+    if created:
+        forget_missing_user(client.id, user_id)
     app.logger.info('Registered device: %s/%s/%s', client.name, user_id,
                     dev.handle)
     return dev.get_descriptor(get_metadata(dev))
@@ -221,14 +419,13 @@ def register(user_id):
     if request.method == 'POST':
         # Response
         return jsonify(_register_response(
-            user_id, RegisterResponseData.wrap(request.get_json(force=True))))
+            user_id, RegisterResponseData.wrap(get_json())))
     else:
         # Request
         challenge = request.args.get('challenge', type=websafe_decode)
         if challenge is None:
             challenge = os.urandom(32)
-        properties = request.args.get('properties', {},
-                                      lambda x: json.loads(unquote(x)))
+        properties = request.args.get('properties', {}, _parse_properties)
 
         return jsonify(_register_request(user_id, challenge, properties))
 
@@ -236,7 +433,8 @@ def register(user_id):
 def _sign_request(user_id, challenge, handles, properties):
     client = get_client()
     user = get_user(user_id)
-    if user is None or len(user.devices) == 0:
+    user_keys = get_user_keys(user) if user is not None else []
+    if not user_keys:
         app.logger.info('User "%s" has no devices registered', user_id)
         raise exc.NoEligibleDevicesException('No devices registered', [])
 
@@ -244,36 +442,42 @@ def _sign_request(user_id, challenge, handles, properties):
     descriptors = []
     handle_map = {}
 
+    record_devices(len(user_keys))
+    keys_by_handle = dict((k['handle'], k) for k in user_keys)
     if not handles:
-        handles = user.devices.keys()
+        handles = [k['handle'] for k in user_keys]
 
     for handle in handles:
         try:
-            dev = user.devices[handle]
+            k = keys_by_handle[handle]
         except KeyError:
             raise exc.BadInputException('Invalid device handle: ' + handle)
-        if not dev.compromised:
-            descriptor = dev.get_descriptor(get_metadata(dev))
-            descriptors.append(descriptor)
-            key = _get_registered_key(dev, descriptor)
+        if not k['compromised']:
+            descriptors.append(k['descriptor'])
+            key = _client_key(k['key'])
             registered_keys.append(key)
-            handle_map[key['keyHandle']] = dev.handle
+            handle_map[key['keyHandle']] = handle
 
     if not registered_keys:
         raise exc.NoEligibleDevicesException(
             'All devices compromised',
-            [d.get_descriptor() for d in user.devices.values()]
+            [dict((name, value) for name, value in k['descriptor'].items()
+                  if name != 'metadata') for k in user_keys]
         )
 
-    request_data = begin_authentication(
-        client.app_id,
-        registered_keys,
-        challenge
-    )
-    request_data['handleMap'] = handle_map
-    request_data['properties'] = properties
-
-    store.store(client.id, user_id, challenge, request_data.json)
+    with phase('crypto'):
+        request_data = begin_authentication(
+            client.app_id,
+            registered_keys,
+            challenge
+        )
+    with phase('store'):
+        store.store(client.id, user_id, challenge, {
+            'appId': request_data['appId'],
+            'challenge': request_data['challenge'],
+            'handles': handle_map,
+            'properties': properties
+        })
     data = SignRequestData.wrap(request_data.data_for_client)
     data['descriptors'] = descriptors
     return data
@@ -281,16 +485,22 @@ def _sign_request(user_id, challenge, handles, properties):
 
 def _sign_response(user_id, response_data):
     client = get_client()
-    user = get_user(user_id)
+    user = get_user(user_id, use_cache=False)
     sign_response = response_data.signResponse
     challenge = sign_response.clientData.challenge
-    request_data = store.retrieve(client.id, user_id, challenge)
-    if request_data is None:
-        raise exc.NotFoundException('Transaction not found')
-    request_data = json.loads(request_data)
-    device, counter, presence = complete_authentication(
-        request_data, sign_response, client.valid_facets)
-    dev = user.devices[request_data['handleMap'][device['keyHandle']]]
+    transaction = _retrieve_transaction(user_id, challenge)
+    handles = transaction['handles']
+    request_data = {
+        'appId': transaction['appId'],
+        'challenge': transaction['challenge'],
+        'registeredKeys': [_load_bind_data(user.devices[h].bind_data)
+                           for h in set(handles.values())
+                           if h in user.devices]
+    }
+    with phase('crypto'):
+        device, counter, presence = complete_authentication(
+            request_data, sign_response, client.valid_facets)
+    dev = user.devices[handles[device['keyHandle']]]
     if dev.compromised:
         raise exc.DeviceCompromisedException('Device is compromised',
                                              dev.get_descriptor())
@@ -299,8 +509,8 @@ def _sign_response(user_id, response_data):
     if counter > (dev.counter or -1):
         dev.counter = counter
         dev.authenticated_at = datetime.now()
-        dev.update_properties(request_data['properties'])
-        dev.update_properties(response_data.properties)
+        dev.update_properties(transaction['properties'],
+                              response_data.properties)
         db.session.commit()
         return dev.get_descriptor(get_metadata(dev))
     else:
@@ -315,14 +525,13 @@ def sign(user_id):
     if request.method == 'POST':
         # Response
         return jsonify(_sign_response(
-            user_id, SignResponseData.wrap(request.get_json(force=True))))
+            user_id, SignResponseData.wrap(get_json())))
     else:
         # Request
         challenge = request.args.get('challenge', type=websafe_decode)
         if challenge is None:
             challenge = os.urandom(32)
-        properties = request.args.get('properties', {},
-                                      lambda x: json.loads(unquote(x)))
+        properties = request.args.get('properties', {}, _parse_properties)
         handles = request.args.getlist('handle')
 
         return jsonify(_sign_request(user_id, challenge, handles, properties))
@@ -336,7 +545,14 @@ def device(user_id, handle):
     if _HANDLE_PATTERN.match(handle) is None:
         raise exc.BadInputException('Invalid device handle: ' + handle)
 
-    user = get_user(user_id)
+    user = get_user(user_id, use_cache=request.method == 'GET')
+    if request.method == 'GET' and user is not None:
+        # Each device has its own ETag, so that a matching If-None-Match
+        # implies that the device existed.
+        etag = '%s-%s' % (_user_etag(user), handle)
+        resp = check_etag(etag)
+        if resp is not None:
+            return resp
     try:
         dev = user.devices[handle]
     except (AttributeError, KeyError):
@@ -346,17 +562,20 @@ def device(user_id, handle):
         if dev is not None:
             app.logger.info('Delete handle: %s/%s/%s', user.client.name,
                             user.name, handle)
-            db.session.delete(dev)
+            delete_devices([dev.id])
             db.session.commit()
         return ('', 204)
     elif request.method == 'POST':
         if dev is None:
             raise exc.NotFoundException('Device not found')
-        dev.update_properties(request.get_json(force=True))
+        dev.update_properties(get_json())
         db.session.commit()
     else:
         if dev is None:
             raise exc.NotFoundException('Device not found')
+        resp = jsonify(dev.get_descriptor(get_metadata(dev)))
+        resp.set_etag(etag)
+        return resp
     return jsonify(dev.get_descriptor(get_metadata(dev)))
 
 
@@ -370,3 +589,144 @@ def device_certificate(user_id, handle):
     except KeyError:
         raise exc.BadInputException('Invalid device handle: ' + handle)
     return dev.certificate.get_pem()
+
+
+# Batch requests
+
+
+_BATCH_OPERATIONS = {}
+_READ_OPERATIONS = set(['listDevices', 'getDevice', 'beginSign'])
+
+
+def batch_operation(name):
+    """Registers a function handling an operation of a batch request.
+
+    The function is called with the user id and the operation, and returns
+    the result of the operation.
+    """
+    def inner(func):
+        _BATCH_OPERATIONS[name] = func
+        return func
+    return inner
+
+
+def _get_field(operation, name, types, default=None):
+    value = operation.get(name, default)
+    if not isinstance(value, types):
+        raise exc.BadInputException('Invalid or missing field: ' + name)
+    return value
+
+
+def _get_properties(operation, default=None):
+    properties = _get_field(operation, 'properties', dict, default)
+    for value in properties.values():
+        if value is not None and not isinstance(value, six.string_types):
+            raise exc.BadInputException(
+                'Property values must be strings or null')
+    return properties
+
+
+def _get_handle(operation):
+    handle = _get_field(operation, 'handle', six.string_types)
+    if _HANDLE_PATTERN.match(handle) is None:
+        raise exc.BadInputException('Invalid device handle: ' + handle)
+    return handle
+
+
+@batch_operation('listDevices')
+def _batch_list_devices(user_id, operation):
+    user = get_user(user_id)
+    if user is None:
+        return []
+    return [k['descriptor'] for k in get_user_keys(user)]
+
+
+@batch_operation('getDevice')
+def _batch_get_device(user_id, operation):
+    handle = _get_handle(operation)
+    user = get_user(user_id)
+    for k in get_user_keys(user) if user is not None else []:
+        if k['handle'] == handle:
+            return k['descriptor']
+    raise exc.NotFoundException('Device not found')
+
+
+@batch_operation('updateProperties')
+def _batch_update_properties(user_id, operation):
+    handle = _get_handle(operation)
+    properties = _get_properties(operation)
+    user = get_user(user_id, use_cache=False)
+    try:
+        dev = user.devices[handle]
+    except (AttributeError, KeyError):
+        raise exc.NotFoundException('Device not found')
+    dev.update_properties(properties)
+    # Each operation is committed on its own, like beginSign (which commits
+    # the transaction it stores). This also bumps the version of the user,
+    # so that later operations see the change.
+    db.session.commit()
+    return dev.get_descriptor(get_metadata(dev))
+
+
+@batch_operation('beginSign')
+def _batch_begin_sign(user_id, operation):
+    challenge = _get_field(operation, 'challenge',
+                           six.string_types + (type(None),))
+    if challenge is None:
+        challenge = os.urandom(32)
+    else:
+        challenge = websafe_decode(challenge)
+    handles = _get_field(operation, 'handles', list, [])
+    if not all(isinstance(h, six.string_types) for h in handles):
+        raise exc.BadInputException('Invalid or missing field: handles')
+    return _sign_request(
+        user_id, challenge, handles, _get_properties(operation, {}))
+
+
+def _run_operation(operation):
+    try:
+        if not isinstance(operation, dict):
+            raise exc.BadInputException('Invalid operation')
+        func = _BATCH_OPERATIONS.get(operation.get('op'))
+        if func is None:
+            raise exc.BadInputException(
+                'Unknown operation: %s' % operation.get('op'))
+        user_id = _get_field(operation, 'user', six.string_types)
+        ratelimit.check_user(user_id)
+        return {'status': 200, 'result': func(user_id, operation)}
+    except exc.U2fException as e:
+        record_error(e.code)
+        return {
+            'status': e.status_code,
+            'errorCode': e.code,
+            'errorMessage': e.message
+        }
+    except ValueError as e:
+        record_error(exc.BadInputException.code)
+        return {
+            'status': 400,
+            'errorCode': exc.BadInputException.code,
+            'errorMessage': str(e)
+        }
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    operations = get_json()
+    if not isinstance(operations, list):
+        raise exc.BadInputException('Batch request must be a list')
+    max_operations = app.config.get('BATCH_MAX_OPERATIONS')
+    if max_operations is not None and len(operations) > max_operations:
+        raise exc.BadInputException(
+            'Too many operations, maximum is %d' % max_operations)
+
+    valid = [o for o in operations if isinstance(o, dict) and
+             isinstance(o.get('user'), six.string_types)]
+    prefetch_users([o['user'] for o in valid])
+    users = [get_user(o['user']) for o in valid
+             if o.get('op') in _READ_OPERATIONS]
+    prefetch_user_keys([u for u in users if u is not None])
+    record_devices(sum(len(keys) for keys in g.user_keys.values()))
+
+    results = [_run_operation(operation) for operation in operations]
+    return jsonify(results)